@@ -1,88 +1,481 @@
+import aiohttp
 import discord
 from discord.ext import commands
 import asyncio
+import atexit
 import io
-from typing import List, Dict, Any, Optional
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import tempfile
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, Optional, Tuple, Union
 from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
-from sqlalchemy import desc, func
+from sqlalchemy import desc, func, insert, select, text
+from sqlalchemy.exc import SQLAlchemyError
+from openai import OpenAIError
 
-from database import get_db, SessionLocal
-from models import User, Report, ReportChunk, Message, MessageRole
+from database import get_db, SessionLocal, engine
+from models import (User, Report, ReportChunk, Message, SemanticCacheEntry, MessageRole,
+                    ConversationStage)
 from pdf_processor import PDFProcessor
 from openai_client import OpenAIClient
-from config import DISCORD_TOKEN, BOT_MENTION_NAME, MAX_CHUNKS_PER_QUERY
+from config import (DISCORD_TOKEN, BOT_MENTION_NAME, MAX_CHUNKS_PER_QUERY,
+                    HNSW_EF_SEARCH, MAX_HISTORY_TURNS, THREAD_CACHE_SIZE,
+                    CHUNK_INSERT_PAGE_SIZE, HISTORY_CACHE_SIZE,
+                    MAX_PDF_BYTES, PDF_INGEST_CONCURRENCY, PDF_PAGES_PER_TASK,
+                    PDF_PROCESS_WORKERS, PDF_SPOOL_BYTES,
+                    REPORT_VECTOR_CACHE_BYTES, REPORT_VECTOR_MAX_CHUNKS,
+                    SEMANTIC_CACHE_MIN_SIMILARITY, SHORT_FOLLOWUP_CHARS,
+                    STREAM_EDIT_INTERVAL, LOG_FORMAT, LOG_LEVEL)
+
+logger = logging.getLogger(__name__)
+
+def setup_logging():
+    """Log through a queue: handlers write to stdout on a listener thread, never on the event loop"""
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    atexit.register(listener.stop)  # Flushes queued records on exit
+
+def init_pdf_worker():
+    """PDF worker processes have no listener thread: log straight to stderr"""
+    logging.basicConfig(format=LOG_FORMAT, level=LOG_LEVEL, force=True)
 
 # Bot configuration
 intents = discord.Intents.default()
 intents.message_content = True
 intents.guilds = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+# Static opening-turn text, built once rather than per upload
+ANTIBIOTICS_QUESTION = "Did you take any antibiotics around the time of the test?"
+MISSING_DATE_RESPONSE = (
+    "Looks like the report date is missing.\nWhen did you take this test? (Month & year is enough.)\n\n"
+    + ANTIBIOTICS_QUESTION
+)
+
+# HNSW filters by report_id only after collecting ef_search candidates, so keep the
+# candidate list well above the number of chunks we want back (at least 10x). Once
+# many reports share the index, even that can leave fewer than MAX_CHUNKS_PER_QUERY
+# of this report's chunks among the candidates; iterative scans (pgvector >= 0.8)
+# keep walking the graph until the filtered LIMIT is met, in distance order.
+# Both settings go in one round trip.
+SET_HNSW_SEARCH = text(
+    f"SET LOCAL hnsw.ef_search = {max(HNSW_EF_SEARCH, MAX_CHUNKS_PER_QUERY * 10)}; "
+    "SET LOCAL hnsw.iterative_scan = strict_order"
+)
+
+# History entries are kept in OpenAI chat form, so cached turns go into prompts as-is
+CHAT_ROLES = {MessageRole.USER: "user", MessageRole.BOT: "assistant"}
+
+# Follow-up prompts and canned replies, hoisted so they are not rebuilt per message
+EXECUTIVE_SUMMARY_PREFIX = 'executive summary of microbiome report and lifestyle:'
+INSIGHT_FOLLOWUP_QUESTION = "Generate one specific actionable insight based on their microbiome data and lifestyle."
+INSIGHT_HEADER = "**One actionable insight:** "
+# Phrases check_and_send_followups looks for in the last bot message; case-insensitive
+# patterns avoid lowercasing a copy of the reply, and the alternation is a single pass
+EXECUTIVE_SUMMARY_PATTERN = re.compile(r"executive summary", re.IGNORECASE)
+FOLLOWUP_SENT_PATTERN = re.compile(r"actionable insight|feel free to ask", re.IGNORECASE)
+QA_INVITATION_LONG = "Feel free to ask any questions about your results! I'm here to help you understand your microbiome better."
+QA_INVITATION = "Feel free to ask any questions about your results!"
+RECOMMENDATIONS_PROMPT = "Based on the conversation history and microbiome data, provide exactly 3 specific, actionable recommendations for improving their microbiome health. Be concise and practical."
+INSIGHT_PROMPT = "Based on the conversation history and microbiome data, provide exactly one specific, actionable insight the user can implement immediately to improve their gut health. Be concise and practical."
+
+# Messages answered without the RAG pipeline during free-form Q&A
+SMALL_TALK = frozenset({
+    "ok", "okay", "k", "kk", "cool", "nice", "great", "thanks", "thank you", "thx", "ty",
+    "got it", "sounds good", "awesome", "perfect", "lol", "haha", "np",
+})
+STREAMING_PLACEHOLDER = "💭 Thinking..."
+SMALL_TALK_RESPONSE = "👍 Anything else you'd like to know about your results?"
+
+async def gather_settled(*aws):
+    """Run awaitables concurrently, wait for all of them, then raise the first error if any"""
+    # Unlike a bare gather(), nothing is left running on failure, so a worker
+    # thread can't still be using the event's Session once the handler bails out.
+    # Pass at most one DB awaitable per call: a Session is not safe to share.
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+def is_small_talk(content: str) -> bool:
+    """True for acknowledgements and emoji/punctuation-only messages with no question in them"""
+    normalized = " ".join(content.lower().split()).strip(" .!?")
+    # No letters or digits at all: emoji, reactions, punctuation
+    return normalized in SMALL_TALK or not any(char.isalnum() for char in normalized)
+
+def split_message(content: str, limit: int = 1950) -> List[str]:
+    """Split a long reply into Discord-sized pieces, by paragraph and then by sentence"""
+    # Collect pieces in a list with a running length rather than re-concatenating
+    # the pending chunk string on every paragraph
+    chunks = []
+    pending = []
+    pending_len = 0
+    
+    def flush():
+        nonlocal pending_len
+        chunk = "".join(pending).strip()
+        if chunk:
+            chunks.append(chunk)
+        pending.clear()
+        pending_len = 0
+    
+    for paragraph in content.split('\n\n'):
+        # If adding this paragraph would exceed limit, send current chunk (+2 leaves a buffer)
+        if pending_len + len(paragraph) + 2 > limit:
+            flush()
+        
+        # If single paragraph is too long, split by sentences
+        if len(paragraph) > limit:
+            for sentence in paragraph.split('. '):
+                if pending_len + len(sentence) + 2 > limit:
+                    flush()
+                pending.append(sentence + ". ")
+                pending_len += len(sentence) + 2
+        else:
+            pending.append(paragraph + "\n\n")
+            pending_len += len(paragraph) + 2
+    
+    flush()
+    return chunks
+
+async def download_to_file(url: str, path: str, block_size: int = 1 << 16):
+    """Stream a download to disk block by block (Attachment.save buffers the whole file first)"""
+    async with aiohttp.ClientSession() as session, session.get(url) as response:
+        response.raise_for_status()
+        with open(path, 'wb') as out:
+            async for block in response.content.iter_chunked(block_size):
+                out.write(block)
+
+async def parse_pdf(pdf_source: Union[bytes, str]) -> Dict[str, Any]:
+    """Parse a PDF in the worker pool, extracting page ranges of long documents in parallel"""
+    loop = asyncio.get_running_loop()
+    page_count = await loop.run_in_executor(pdf_pool, pdf_processor.page_count, pdf_source)
+    
+    # Enough ranges to spread over every worker, but not so small that reopening the
+    # document in each task outweighs the pages it extracts
+    step = max(PDF_PAGES_PER_TASK, -(-page_count // PDF_PROCESS_WORKERS))
+    parts = await asyncio.gather(*(
+        loop.run_in_executor(pdf_pool, pdf_processor.extract_page_texts,
+                             pdf_source, first_page, first_page + step)
+        for first_page in range(0, page_count, step)
+    ))
+    text_content = [text for part in parts for text in part]
+    if not text_content:
+        raise Exception("Failed to process PDF: No readable text found in PDF")
+    
+    return await loop.run_in_executor(pdf_pool, pdf_processor.process_text, "\n\n".join(text_content))
+
+def live_preview(reply: discord.Message, limit: int = 1950):
+    """Build an on_text callback that shows a streaming response by editing reply, throttled"""
+    parts = []
+    last_edit = time.monotonic()
+    
+    async def on_text(delta: str):
+        nonlocal last_edit
+        parts.append(delta)
+        now = time.monotonic()
+        if now - last_edit < STREAM_EDIT_INTERVAL:
+            return
+        last_edit = now
+        preview = "".join(parts)
+        try:
+            # The final text replaces this (split if needed) once the stream ends
+            await reply.edit(content=preview[:limit] + " ▌")
+        except discord.HTTPException as e:
+            logger.warning(f"⚠️  Streaming preview edit failed: {e}")
+    
+    return on_text
+
+def message_row(message_id: int, report_id: int, user_id: Optional[int], role: str, content: str,
+                input_tokens: int = 0, output_tokens: int = 0, cost_usd: float = 0.0,
+                chunk_ids: Optional[List[int]] = None) -> Dict[str, Any]:
+    """Column values for one messages row, for BiomeBot.save_messages"""
+    return {
+        "id": message_id,
+        "report_id": report_id,
+        "user_id": user_id,
+        "role": role,
+        "content": content,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cost_usd": cost_usd,
+        "retrieved_chunk_ids": chunk_ids or []
+    }
+
+class BiomeDiscordBot(commands.Bot):
+    async def close(self):
+        """Shut down Discord first, then release the OpenAI connection pool and PDF workers"""
+        await super().close()
+        await openai_client.close()
+        pdf_pool.shutdown(wait=False, cancel_futures=True)
+
+bot = BiomeDiscordBot(command_prefix='!', intents=intents)
 pdf_processor = PDFProcessor()
+# PyPDF2 parsing is pure Python and holds the GIL, so a worker thread still competes
+# with the event loop (and Discord's heartbeat); worker processes parse in parallel
+pdf_pool = ProcessPoolExecutor(max_workers=PDF_PROCESS_WORKERS, initializer=init_pdf_worker)
 openai_client = OpenAIClient()
 
 class BiomeBot:
     def __init__(self):
-        self.processing_users = set()  # Track users currently processing PDFs
+        # Identity caches: user and report ids never change once written
+        self._known_user_ids: set = set()  # Discord user IDs present in the users table
+        # thread ID -> report ID (None if not a report thread), LRU-bounded
+        self._thread_reports: OrderedDict[int, Optional[int]] = OrderedDict()
+        # report ID -> last MAX_HISTORY_TURNS messages, kept current by save_message, LRU-bounded
+        self._histories: OrderedDict[int, deque] = OrderedDict()
+        # report ID -> (chunk ID, content) pairs behind the last answer, LRU-bounded
+        self._last_chunks: OrderedDict[int, List[Tuple[int, str]]] = OrderedDict()
+        # report ID -> (chunk IDs, contents, int8 embedding matrix, per-row scales), or None for
+        # reports too large to mirror; LRU-bounded by the matrices' total size
+        self._report_vectors: OrderedDict[int, Optional[Tuple[List[int], List[str], np.ndarray, np.ndarray]]] = OrderedDict()
+        self._report_vector_bytes = 0
+        # Caps PDF ingests in flight (parsing, embedding, bulk insert) across all users
+        self.ingest_slots = asyncio.Semaphore(PDF_INGEST_CONCURRENCY)
+    
+    def _remember_thread(self, thread_id: int, report_id: Optional[int]):
+        """Record a thread's report ID, evicting the least recently used entry when full"""
+        self._thread_reports[thread_id] = report_id
+        self._thread_reports.move_to_end(thread_id)
+        if len(self._thread_reports) > THREAD_CACHE_SIZE:
+            self._thread_reports.popitem(last=False)
+    
+    def _remember_chunks(self, report_id: int, chunks: List[Tuple[int, str]]):
+        """Record the chunks used for a report's latest answer, evicting the least recently used report when full"""
+        self._last_chunks[report_id] = chunks
+        self._last_chunks.move_to_end(report_id)
+        if len(self._last_chunks) > HISTORY_CACHE_SIZE:
+            self._last_chunks.popitem(last=False)
+    
+    def _remember_vectors(self, report_id: int, chunk_ids: List[int], contents: List[str],
+                          embeddings: Any):
+        """Mirror a report's chunk embeddings in memory, evicting least recently used reports past the byte budget"""
+        # Ingest warm-up and the lazy load can both fill the same report: drop the old
+        # entry's bytes first so the running total doesn't drift upward
+        self._forget_vectors(report_id)
+        if len(chunk_ids) > REPORT_VECTOR_MAX_CHUNKS:
+            self._report_vectors[report_id] = None  # Searched through pgvector instead
+            return
+        
+        # One contiguous (chunks x dims) int8 matrix with a scale per row: a quarter of the
+        # float32 footprint, with negligible effect on cosine ranking over hundreds of dimensions
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        scales = np.abs(matrix).max(axis=1) / 127
+        scales[scales == 0] = 1  # All-zero rows quantize to zeros either way
+        quantized = np.rint(matrix / scales[:, None]).astype(np.int8)
+        scales = scales.astype(np.float32)
+        self._report_vectors[report_id] = (chunk_ids, contents, quantized, scales)
+        self._report_vector_bytes += quantized.nbytes + scales.nbytes
+        while self._report_vector_bytes > REPORT_VECTOR_CACHE_BYTES and self._report_vectors:
+            self._forget_vectors(next(iter(self._report_vectors)))
+    
+    def _forget_vectors(self, report_id: int):
+        """Drop a report's in-memory mirror (if any) and release its bytes from the budget"""
+        evicted = self._report_vectors.pop(report_id, None)
+        if evicted is not None:
+            self._report_vector_bytes -= evicted[2].nbytes + evicted[3].nbytes
     
-    async def ensure_user_exists(self, discord_user, db: Session) -> User:
-        """Ensure user exists in database"""
-        user = db.query(User).filter(User.id == discord_user.id).first()
-        if not user:
-            user = User(
-                id=discord_user.id,
-                username=discord_user.display_name or discord_user.name
+    async def _report_chunk_vectors(self, report_id: int, db: Session
+                                    ) -> Optional[Tuple[List[int], List[str], np.ndarray, np.ndarray]]:
+        """A report's in-memory chunk mirror, loaded on first use; None if it is too large to mirror"""
+        if report_id in self._report_vectors:
+            self._report_vectors.move_to_end(report_id)
+            return self._report_vectors[report_id]
+        
+        # One row past the limit tells us the report is too large without loading all of it
+        rows = await asyncio.to_thread(
+            lambda: db.query(ReportChunk.id, ReportChunk.content, ReportChunk.embedding).filter(
+                ReportChunk.report_id == report_id
+            ).limit(REPORT_VECTOR_MAX_CHUNKS + 1).all()
+        )
+        if not rows:
+            return None  # Not cached: chunks may still be on their way in
+        
+        self._remember_vectors(
+            report_id,
+            [row.id for row in rows],
+            [row.content for row in rows],
+            [row.embedding for row in rows]
+        )
+        return self._report_vectors.get(report_id)
+    
+    @asynccontextmanager
+    async def user_ingest_lock(self, user_id: int):
+        """Hold a per-user Postgres advisory lock during PDF ingest; yields False if already held"""
+        # Session-level lock: it lives on one dedicated connection, works across bot
+        # processes, and is released by Postgres if that connection drops
+        conn = await asyncio.to_thread(engine.connect)
+        try:
+            acquired = await asyncio.to_thread(
+                lambda: conn.execute(select(func.pg_try_advisory_lock(user_id))).scalar()
             )
-            db.add(user)
-            db.commit()
-            db.refresh(user)
-        return user
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    try:
+                        await asyncio.to_thread(
+                            lambda: conn.execute(select(func.pg_advisory_unlock(user_id)))
+                        )
+                    except Exception as e:
+                        # Don't return a connection still holding the lock to the pool:
+                        # discarding it ends the session, which releases the lock
+                        logger.warning(f"⚠️  Advisory unlock failed for user {user_id}, discarding connection: {e}")
+                        await asyncio.to_thread(conn.invalidate)
+        finally:
+            await asyncio.to_thread(conn.close)
+    
+    async def ensure_user_exists(self, discord_user, db: Session) -> int:
+        """Ensure user exists in database and return its ID"""
+        if discord_user.id in self._known_user_ids:
+            return discord_user.id
+        
+        def get_or_create_user():
+            user = db.query(User).filter(User.id == discord_user.id).first()
+            if not user:
+                user = User(
+                    id=discord_user.id,
+                    username=discord_user.display_name or discord_user.name
+                )
+                db.add(user)
+                db.commit()
+        
+        await asyncio.to_thread(get_or_create_user)
+        
+        # Only cache once the row is known to exist
+        self._known_user_ids.add(discord_user.id)
+        return discord_user.id
     
     async def get_thread_conversation_history(self, report_id: int, db: Session) -> List[Dict[str, str]]:
-        """Get full conversation history for a thread/report"""
-        messages = db.query(Message).filter(
-            Message.report_id == report_id
-        ).order_by(Message.id).all()
+        """Get the most recent MAX_HISTORY_TURNS messages for a thread/report"""
+        history = self._histories.get(report_id)
+        if history is not None:
+            self._histories.move_to_end(report_id)
+            return list(history)
         
-        history = []
-        for msg in messages:
-            history.append({
-                "role": msg.role,
-                "content": msg.content
-            })
+        # Cold start for this report: newest first so LIMIT keeps the tail, then restore chronological order.
+        # Plain (role, content) rows: no ORM identity-map bookkeeping per message.
+        rows = await asyncio.to_thread(
+            lambda: db.query(Message.role, Message.content).filter(
+                Message.report_id == report_id
+            ).order_by(desc(Message.id)).limit(MAX_HISTORY_TURNS).all()
+        )
         
-        return history
+        history = deque(
+            ({"role": CHAT_ROLES[role], "content": content} for role, content in reversed(rows)),
+            maxlen=MAX_HISTORY_TURNS
+        )
+        self._histories[report_id] = history
+        if len(self._histories) > HISTORY_CACHE_SIZE:
+            self._histories.popitem(last=False)
+        return list(history)
     
-    async def find_relevant_chunks(self, query: str, report_id: int, db: Session) -> List[str]:
-        """Find relevant chunks for query using vector similarity"""
+    async def find_cached_response(self, query: str, report_id: int, db: Session,
+                                   query_embedding: Optional[np.ndarray] = None
+                                   ) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """Look up a past answer to a near-identical question on this report; returns (answer, query embedding)"""
         try:
-            # Get query embedding
-            query_embedding = openai_client.get_embedding(query)
+            if query_embedding is None:
+                query_embedding = await openai_client.aget_embedding(query)
             
-            # Try pgvector similarity search first
-            try:
-                from pgvector.sqlalchemy import Vector
+            def lookup():
+                # Unit vectors: inner product is cosine similarity, and <#> is its negative
+                distance = SemanticCacheEntry.query_embedding.max_inner_product(query_embedding)
+                return db.query(SemanticCacheEntry.response_text, distance).filter(
+                    SemanticCacheEntry.report_id == report_id,
+                    distance <= -SEMANTIC_CACHE_MIN_SIMILARITY
+                ).order_by(distance).limit(1).first()
+            
+            hit = await asyncio.to_thread(lookup)
+            if hit is None:
+                return None, query_embedding
+            # Logged so the threshold can be checked against the answers actually reused
+            logger.info(f"♻️  Semantic cache hit for report {report_id} (similarity {-hit[1]:.3f})")
+            return hit[0], query_embedding
+        
+        except (SQLAlchemyError, OpenAIError) as e:
+            # A cache failure just means generating the answer normally
+            logger.error(f"Error checking semantic cache: {e}")
+            await rollback_quietly(db)
+            return None, query_embedding
+    
+    async def cache_response(self, report_id: int, query_embedding: np.ndarray, response_text: str, db: Session):
+        """Remember an answer for reuse on near-identical questions"""
+        def persist():
+            db.execute(insert(SemanticCacheEntry).values(
+                report_id=report_id,
+                query_embedding=query_embedding,
+                response_text=response_text
+            ))
+            db.commit()
+        
+        try:
+            await asyncio.to_thread(persist)
+        except SQLAlchemyError as e:
+            logger.error(f"Error saving to semantic cache: {e}")
+            await rollback_quietly(db)
+    
+    async def find_relevant_chunks(self, query: str, report_id: int, db: Session,
+                                   query_embedding: Optional[np.ndarray] = None) -> List[Tuple[int, str]]:
+        """Find relevant chunks for query using vector similarity; returns (chunk ID, content) pairs"""
+        try:
+            # Get query embedding, unless the caller already has it
+            if query_embedding is None:
+                query_embedding = await openai_client.aget_embedding(query)
+            
+            # Typical reports are ranked exactly in memory: one matrix-vector product
+            # instead of an index scan and a database round trip
+            vectors = await self._report_chunk_vectors(report_id, db)
+            if vectors is not None:
+                chunk_ids, contents, quantized, scales = vectors
+                # Stored embeddings are unit vectors, so rescaled dot products are cosine
+                # similarities. The query stays float32: NumPy has no int8 GEMV, and an
+                # unquantized query keeps ranking error to the stored side only.
+                scores = (quantized @ np.asarray(query_embedding, dtype=np.float32)) * scales
+                k = min(MAX_CHUNKS_PER_QUERY, len(chunk_ids))
+                top = np.argpartition(-scores, k - 1)[:k]
+                top = top[np.argsort(-scores[top])]
+                return [(chunk_ids[i], contents[i]) for i in top]
+            
+            # Large reports: pgvector HNSW search
+            def search_chunks():
+                # Recall/latency trade-off for the HNSW index, scoped to this transaction
+                db.execute(SET_HNSW_SEARCH)
                 
-                chunks = db.query(ReportChunk).filter(
+                # Project ID and content only; hydrating ReportChunk would ship every vector back
+                return db.query(ReportChunk.id, ReportChunk.content).filter(
                     ReportChunk.report_id == report_id
                 ).order_by(
-                    ReportChunk.embedding.cosine_distance(query_embedding)
+                    # Both sides are unit vectors: <#> (negative inner product) ranks like cosine.
+                    # Keep this the bare ascending operator on the column, matching the
+                    # index's halfvec_ip_ops: wrapping it (1 - x, desc(), a cast) or switching
+                    # to <=> makes Postgres skip the HNSW index and sort every row instead.
+                    ReportChunk.embedding.max_inner_product(query_embedding)
                 ).limit(MAX_CHUNKS_PER_QUERY).all()
+            
+            chunks = await asyncio.to_thread(search_chunks)
+            return [(chunk.id, chunk.content) for chunk in chunks]
                 
-                return [chunk.content for chunk in chunks]
-                
-            except (ImportError, Exception) as e:
-                print(f"pgvector search failed, using fallback: {e}")
-                # Fallback: return first few chunks (not ideal but functional)
-                chunks = db.query(ReportChunk).filter(
-                    ReportChunk.report_id == report_id
-                ).order_by(ReportChunk.chunk_idx).limit(MAX_CHUNKS_PER_QUERY).all()
-                
-                return [chunk.content for chunk in chunks]
-                
-        except Exception as e:
-            print(f"Error finding relevant chunks: {e}")
+        except (SQLAlchemyError, OpenAIError) as e:
+            # Retrieval is best-effort: answer without report context rather than fail
+            logger.error(f"Error finding relevant chunks: {e}")
+            await rollback_quietly(db)
             return []
     
     async def save_message(self, message_id: int, report_id: int, user_id: Optional[int], 
@@ -90,7 +483,9 @@ class BiomeBot:
                           input_tokens: int = 0, output_tokens: int = 0, 
                           cost_usd: float = 0.0, chunk_ids: List[int] = None) -> Message:
         """Save message to database"""
-        message_record = Message(
+        # INSERT ... RETURNING hydrates the row in the same round trip, replacing
+        # the add / commit / refresh sequence
+        stmt = insert(Message).values(
             id=message_id,
             report_id=report_id,
             user_id=user_id,
@@ -100,19 +495,48 @@ class BiomeBot:
             output_tokens=output_tokens,
             cost_usd=cost_usd,
             retrieved_chunk_ids=chunk_ids or []
-        )
-        db.add(message_record)
-        db.commit()
-        db.refresh(message_record)
+        ).returning(Message)
+        
+        def persist():
+            message_record = db.execute(stmt).scalar_one()
+            db.commit()
+            return message_record
+        
+        message_record = await asyncio.to_thread(persist)
+        self._append_history(report_id, role, content)
         return message_record
     
+    async def save_messages(self, rows: List[Dict[str, Any]], db: Session):
+        """Save several messages (full messages-table rows) with one INSERT and one commit"""
+        def persist():
+            db.execute(insert(Message).values(rows))
+            db.commit()
+        
+        await asyncio.to_thread(persist)
+        for row in rows:
+            self._append_history(row["report_id"], row["role"], row["content"])
+    
+    def _append_history(self, report_id: int, role: str, content: str):
+        """Keep a cached history current; uncached reports load from the DB on next use"""
+        history = self._histories.get(report_id)
+        if history is not None:
+            history.append({"role": CHAT_ROLES[MessageRole(role)], "content": content})
+    
     async def process_pdf_upload(self, message: discord.Message, attachment: discord.Attachment, db: Session):
         """Process PDF upload and create thread"""
-        user = await self.ensure_user_exists(message.author, db)
+        user_id = await self.ensure_user_exists(message.author, db)
         
+        spool_path = None
         try:
-            # Download PDF first
-            pdf_bytes = await attachment.read()
+            # Download PDF first: small files into memory, large ones to a temp file the
+            # parser memory-maps, so neither process holds the whole PDF in RAM
+            if attachment.size > PDF_SPOOL_BYTES:
+                spool_fd, spool_path = tempfile.mkstemp(suffix=".pdf")
+                os.close(spool_fd)
+                await download_to_file(attachment.url, spool_path)
+                pdf_source = spool_path
+            else:
+                pdf_source = await attachment.read()
             
             # Create unique thread name with counter if needed
             base_name = f"🧬 {attachment.filename} - {message.author.display_name}"
@@ -148,85 +572,98 @@ class BiomeBot:
                 else:
                     raise e
             
-            # Process PDF
-            await thread.send("📊 Analyzing your microbiome report...")
-            
-            processed_data = pdf_processor.process_pdf(pdf_bytes)
+            # Process PDF: parse in worker processes (so other users aren't stalled)
+            # while the status message goes out
+            processed_data, _ = await gather_settled(
+                parse_pdf(pdf_source),
+                thread.send("📊 Analyzing your microbiome report...")
+            )
+            # Only the extracted text is needed from here on; drop the raw PDF so it
+            # isn't held in memory through the embedding phase
+            del pdf_source
             
             # Create report record
             sample_date = None
             if processed_data['metadata'].get('sample_date'):
                 # Convert ISO string back to datetime for database field
-                from datetime import datetime
                 sample_date = datetime.fromisoformat(processed_data['metadata']['sample_date'])
             
             report = Report(
-                user_id=user.id,
+                user_id=user_id,
                 thread_id=thread.id,
                 original_filename=attachment.filename,
                 sample_date=sample_date,
                 report_metadata=processed_data['metadata']
             )
-            db.add(report)
-            db.commit()
-            db.refresh(report)
             
-            # Create chunks and embeddings
-            await thread.send("🔬 Creating knowledge base from your report...")
+            def persist_report():
+                db.add(report)
+                db.commit()
+                db.refresh(report)
             
-            for chunk_data in processed_data['chunks']:
-                try:
-                    # Get embedding
-                    embedding = openai_client.get_embedding(chunk_data['content'])
-                    
-                    chunk = ReportChunk(
-                        report_id=report.id,
-                        chunk_idx=chunk_data['chunk_idx'],
-                        content=chunk_data['content']
-                    )
-                    
-                    # Set embedding based on available method
-                    try:
-                        chunk.embedding = embedding
-                    except AttributeError:
-                        # Fallback to array storage
-                        chunk.embedding_array = embedding
-                    
-                    db.add(chunk)
-                    
-                except Exception as e:
-                    print(f"Error processing chunk {chunk_data['chunk_idx']}: {e}")
-                    continue
+            # Embed all chunks in batched requests instead of one request per chunk.
+            # Embedding doesn't need the report ID, so it overlaps the report INSERT
+            # and the status message.
+            chunk_texts = [chunk_data['content'] for chunk_data in processed_data['chunks']]
+            _, _, embeddings = await gather_settled(
+                asyncio.to_thread(persist_report),
+                thread.send("🔬 Creating knowledge base from your report..."),
+                openai_client.aget_embeddings_batch(chunk_texts)
+            )
+
+            chunk_rows = [
+                {
+                    "report_id": report.id,
+                    "chunk_idx": chunk_data['chunk_idx'],
+                    "content": chunk_data['content'],
+                    "embedding": embedding
+                }
+                for chunk_data, embedding in zip(processed_data['chunks'], embeddings)
+            ]
+
+            # Single executemany INSERT rather than one ORM flush per chunk, paged so a
+            # huge report never builds one giant VALUES statement; run off the event
+            # loop so Discord heartbeats keep flowing
+            def insert_chunks():
+                chunk_ids = []
+                if chunk_rows:
+                    # RETURNING in parameter order gives each row's ID for the in-memory mirror
+                    chunk_ids = db.execute(
+                        insert(ReportChunk).returning(ReportChunk.id, sort_by_parameter_order=True)
+                        .execution_options(insertmanyvalues_page_size=CHUNK_INSERT_PAGE_SIZE),
+                        chunk_rows
+                    ).scalars().all()
+                db.commit()
+                return chunk_ids
             
-            db.commit()
+            chunk_ids = await asyncio.to_thread(insert_chunks)
+            # Warm the retrieval mirror with the embeddings we already hold
+            if chunk_ids:
+                self._remember_vectors(report.id, chunk_ids, chunk_texts, embeddings)
             
-            # Initial analysis based on extracted date
-            if processed_data['metadata'].get('sample_date'):
-                sample_date_str = processed_data['metadata']['sample_date']
+            # Initial analysis based on extracted date (parsed above for the report row)
+            if sample_date is not None:
                 age_months = processed_data['metadata'].get('sample_age_months', 0)
                 
-                # Convert ISO string to datetime for formatting
-                from datetime import datetime
-                sample_date_obj = datetime.fromisoformat(sample_date_str)
-                
-                date_response = f"📅 I see your microbiome report was generated on **{sample_date_obj.strftime('%B %d, %Y')}**\n"
-                date_response += f"That's roughly **{age_months} months** ago. Gut profiles can shift fast, so I'll keep that in mind.\n\n"
+                date_response = (
+                    f"📅 I see your microbiome report was generated on **{sample_date.strftime('%B %d, %Y')}**\n"
+                    f"That's roughly **{age_months} months** ago. Gut profiles can shift fast, so I'll keep that in mind.\n\n"
+                    f"{ANTIBIOTICS_QUESTION}"
+                )
             else:
-                date_response = "Looks like the report date is missing.\nWhen did you take this test? (Month & year is enough.)\n\n"
-            
-            date_response += "Did you take any antibiotics around the time of the test?"
-            
-            # Send initial response
-            bot_message = await thread.send(date_response)
+                date_response = MISSING_DATE_RESPONSE
             
-            # Save messages to database
-            await self.save_message(
-                message_id=message.id,
-                report_id=report.id,
-                user_id=user.id,
-                role=MessageRole.USER.value,
-                content=f"[PDF Upload: {attachment.filename}]",
-                db=db
+            # Send initial response while the upload message is saved
+            bot_message, _ = await gather_settled(
+                thread.send(date_response),
+                self.save_message(
+                    message_id=message.id,
+                    report_id=report.id,
+                    user_id=user_id,
+                    role=MessageRole.USER.value,
+                    content=f"[PDF Upload: {attachment.filename}]",
+                    db=db
+                )
             )
             
             await self.save_message(
@@ -238,216 +675,277 @@ class BiomeBot:
                 db=db
             )
             
-            print(f"✅ Processed PDF for user {user.username}: {report.id}")
+            self._remember_thread(thread.id, report.id)
+            
+            logger.info(f"✅ Processed PDF for user {message.author.display_name}: {report.id}")
             
         except Exception as e:
-            print(f"Error processing PDF: {e}")
+            logger.error(f"Error processing PDF: {e}")
             await message.reply(f"❌ Sorry, I couldn't process your PDF: {str(e)}")
+        finally:
+            if spool_path is not None:
+                os.unlink(spool_path)
     
     async def handle_thread_message(self, message: discord.Message, db: Session):
         """Handle message in an existing thread"""
-        # Find report by thread ID
-        report = db.query(Report).filter(Report.thread_id == message.channel.id).first()
+        # Find report by thread ID, skipping the SELECT for threads seen before
+        thread_id = message.channel.id
+        if thread_id in self._thread_reports:
+            report_id = self._thread_reports[thread_id]
+            self._thread_reports.move_to_end(thread_id)
+        else:
+            report = await asyncio.to_thread(
+                lambda: db.query(Report.id).filter(Report.thread_id == thread_id).first()
+            )
+            report_id = report.id if report else None
+            self._remember_thread(thread_id, report_id)
         
-        if not report:
+        if report_id is None:
             return  # Not a report thread
         
-        user = await self.ensure_user_exists(message.author, db)
+        # Short Q&A follow-ups ("why?", "tell me more") are about the same report sections
+        # as the previous answer and will reuse those chunks (decided once the stage is known)
+        short_followup = len(message.content.strip()) <= SHORT_FOLLOWUP_CHARS and report_id in self._last_chunks
         
-        # Save user message
-        await self.save_message(
-            message_id=message.id,
-            report_id=report.id,
-            user_id=user.id,
-            role=MessageRole.USER.value,
-            content=message.content,
-            db=db
-        )
+        # The query embedding needs only the text: start it now so the API round trip
+        # overlaps the DB work below (small talk may never need one). A short follow-up
+        # in a scripted stage has none in flight; retrieval embeds it then.
+        embedding_task = None
+        if not short_followup and not is_small_talk(message.content):
+            embedding_task = asyncio.create_task(openai_client.aget_embedding(message.content))
         
-        # Get conversation history
-        conversation_history = await self.get_thread_conversation_history(report.id, db)
+        try:
+            user_id = await self.ensure_user_exists(message.author, db)
+            
+            # The user message is written together with the reply (one INSERT, one commit
+            # per turn); until then it only joins the history used for this turn
+            user_row = message_row(message.id, report_id, user_id, MessageRole.USER.value, message.content)
+            conversation_history = await self.get_thread_conversation_history(report_id, db)
+            conversation_history.append({"role": CHAT_ROLES[MessageRole.USER], "content": message.content})
+            del conversation_history[:-MAX_HISTORY_TURNS]
+            
+            stage = openai_client.determine_stage(conversation_history, message.content)
+            
+            # In the scripted stages a short message is the user's answer to a new stage
+            # prompt, which needs its own retrieval
+            reusable_chunks = None
+            if stage == ConversationStage.QA and short_followup:
+                reusable_chunks = self._last_chunks.get(report_id)
+            
+            # Acknowledgements in free-form Q&A need no retrieval or model call. Only in Q&A:
+            # during the scripted stages a short "ok" or "yes" is the user's answer.
+            if stage == ConversationStage.QA and is_small_talk(message.content):
+                bot_message = await message.reply(SMALL_TALK_RESPONSE)
+                await self.save_messages([
+                    user_row,
+                    message_row(bot_message.id, report_id, None, MessageRole.BOT.value, SMALL_TALK_RESPONSE)
+                ], db)
+                return
+            
+            query_embedding = None
+            if embedding_task is not None:
+                try:
+                    query_embedding = await embedding_task
+                except OpenAIError as e:
+                    # Retrieval retries the embedding and degrades on its own
+                    logger.error(f"Error embedding query: {e}")
+        finally:
+            # An early return or a DB error above leaves the embedding unawaited: stop the
+            # request, or consume its error so asyncio doesn't report it as never retrieved
+            if embedding_task is not None:
+                if not embedding_task.done():
+                    embedding_task.cancel()
+                elif not embedding_task.cancelled():
+                    embedding_task.exception()
         
-        # Find relevant chunks from the report
-        relevant_chunks = await self.find_relevant_chunks(message.content, report.id, db)
+        # Free-form Q&A can reuse an earlier answer to the same question; the scripted
+        # prediction stages depend on the conversation so far and always generate, as do
+        # short follow-ups whose meaning depends on the previous answer
+        cached_response = None
+        if stage == ConversationStage.QA and reusable_chunks is None:
+            cached_response, query_embedding = await self.find_cached_response(
+                message.content, report_id, db, query_embedding
+            )
         
         # Generate response
+        placeholder = None
         try:
-            async with message.channel.typing():
-                response_data = openai_client.create_microbiome_analysis(
+            if cached_response is not None:
+                relevant_chunks, chunk_ids = [], []
+                response_data = {"content": cached_response, "input_tokens": 0, "output_tokens": 0, "cost_usd": 0.0}
+            else:
+                # Find relevant chunks from the report
+                if reusable_chunks is not None:
+                    retrieved = reusable_chunks
+                    self._last_chunks.move_to_end(report_id)
+                else:
+                    retrieved = await self.find_relevant_chunks(message.content, report_id, db, query_embedding)
+                    if retrieved:
+                        self._remember_chunks(report_id, retrieved)
+                # Report order rather than relevance order, so the same sections always
+                # produce the same context message
+                retrieved = sorted(retrieved)
+                chunk_ids = [chunk_id for chunk_id, _ in retrieved]
+                relevant_chunks = [content for _, content in retrieved]
+                
+                # Stream into a placeholder reply so the user sees the answer as it is written
+                placeholder = await message.reply(STREAMING_PLACEHOLDER)
+                response_data = await openai_client.create_microbiome_analysis(
                     conversation_history=conversation_history,
                     relevant_chunks=relevant_chunks,
-                    user_question=message.content
+                    user_question=message.content,
+                    on_text=live_preview(placeholder)
                 )
+                
+                # Same condition as the lookup: scripted predictions and the executive
+                # summary depend on the conversation and must never be served from cache
+                if stage == ConversationStage.QA and query_embedding is not None:
+                    await self.cache_response(report_id, query_embedding, response_data['content'], db)
             
             # Send response in chunks if needed (Discord limit: 2000 chars)
             content = response_data['content']
-            if len(content) <= 2000:
-                bot_message = await message.reply(content)
+            chunks = [content] if len(content) <= 2000 else split_message(content)
+            first_chunk = chunks[0] if chunks else "Response too long to display."
+            
+            # First chunk as the reply (the streamed placeholder, if any), rest as follow-ups
+            if placeholder is not None:
+                await placeholder.edit(content=first_chunk)
+                bot_message = placeholder
             else:
-                # Split into chunks
-                chunks = []
-                current_chunk = ""
-                
-                # Split by paragraphs first
-                paragraphs = content.split('\n\n')
-                
-                for paragraph in paragraphs:
-                    # If adding this paragraph would exceed limit, send current chunk
-                    if len(current_chunk) + len(paragraph) + 2 > 1950:  # Leave buffer
-                        if current_chunk:
-                            chunks.append(current_chunk.strip())
-                            current_chunk = ""
-                    
-                    # If single paragraph is too long, split by sentences
-                    if len(paragraph) > 1950:
-                        sentences = paragraph.split('. ')
-                        for sentence in sentences:
-                            if len(current_chunk) + len(sentence) + 2 > 1950:
-                                if current_chunk:
-                                    chunks.append(current_chunk.strip())
-                                    current_chunk = ""
-                            current_chunk += sentence + ". "
-                    else:
-                        current_chunk += paragraph + "\n\n"
-                
-                # Add remaining content
-                if current_chunk.strip():
-                    chunks.append(current_chunk.strip())
-                
-                # Send first chunk as reply, rest as follow-ups
-                bot_message = await message.reply(chunks[0] if chunks else "Response too long to display.")
-                
-                # Send remaining chunks
-                for chunk in chunks[1:]:
-                    await message.channel.send(chunk)
+                bot_message = await message.reply(first_chunk)
             
-            # Save bot message with cost tracking
-            chunk_ids = []  # Would need to track which chunks were used
-            await self.save_message(
-                message_id=bot_message.id,
-                report_id=report.id,
-                user_id=None,
-                role=MessageRole.BOT.value,
-                content=response_data['content'],
-                db=db,
-                input_tokens=response_data['input_tokens'],
-                output_tokens=response_data['output_tokens'],
-                cost_usd=response_data['cost_usd'],
-                chunk_ids=chunk_ids
-            )
+            # Send remaining chunks
+            for chunk in chunks[1:]:
+                await message.channel.send(chunk)
+            
+            # Save the user message and the bot reply (with cost tracking) together
+            await self.save_messages([
+                user_row,
+                message_row(bot_message.id, report_id, None, MessageRole.BOT.value, response_data['content'],
+                            input_tokens=response_data['input_tokens'],
+                            output_tokens=response_data['output_tokens'],
+                            cost_usd=response_data['cost_usd'],
+                            chunk_ids=chunk_ids)
+            ], db)
+            user_row = None
             
             # Check if this is an executive summary - send automatic follow-ups
-            if response_data['content'].lower().startswith('executive summary of microbiome report and lifestyle:'):
-                print(f"🎯 Executive summary detected! Sending automatic follow-ups...")
+            if response_data['content'].lower().startswith(EXECUTIVE_SUMMARY_PREFIX):
+                logger.info(f"🎯 Executive summary detected! Sending automatic follow-ups...")
                 
-                import asyncio
                 await asyncio.sleep(2)
                 
                 # 1. Send actionable insight
                 try:
-                    insight_response = self.openai.create_microbiome_analysis(
+                    insight_response = await openai_client.create_microbiome_analysis(
                         conversation_history=conversation_history,
                         relevant_chunks=relevant_chunks,
-                        user_question="Generate one specific actionable insight based on their microbiome data and lifestyle."
+                        user_question=INSIGHT_FOLLOWUP_QUESTION
                     )
+                    insight_content = INSIGHT_HEADER + insight_response['content']
                     
-                    insight_msg = await message.channel.send(f"**One actionable insight:** {insight_response['content']}")
+                    insight_msg = await message.channel.send(insight_content)
                     
                     # Save insight message
                     await self.save_message(
                         message_id=insight_msg.id,
-                        report_id=report.id,
+                        report_id=report_id,
                         user_id=None,
                         role=MessageRole.BOT.value,
-                        content=f"**One actionable insight:** {insight_response['content']}",
+                        content=insight_content,
                         db=db,
                         input_tokens=insight_response.get('input_tokens', 0),
                         output_tokens=insight_response.get('output_tokens', 0),
                         cost_usd=insight_response.get('cost_usd', 0.0)
                     )
-                    print(f"✅ Sent actionable insight")
+                    logger.info(f"✅ Sent actionable insight")
                     
                 except Exception as e:
-                    print(f"❌ Error sending actionable insight: {e}")
+                    logger.error(f"❌ Error sending actionable insight: {e}")
+                    await rollback_quietly(db)
                 
                 await asyncio.sleep(2)
                 
                 # 2. Send Q&A invitation
                 try:
-                    qa_msg = await message.channel.send("Feel free to ask any questions about your results! I'm here to help you understand your microbiome better.")
+                    qa_msg = await message.channel.send(QA_INVITATION_LONG)
                     
                     # Save Q&A message
                     await self.save_message(
                         message_id=qa_msg.id,
-                        report_id=report.id,
+                        report_id=report_id,
                         user_id=None,
                         role=MessageRole.BOT.value,
-                        content="Feel free to ask any questions about your results! I'm here to help you understand your microbiome better.",
+                        content=QA_INVITATION_LONG,
                         db=db
                     )
-                    print(f"✅ Sent Q&A invitation")
+                    logger.info(f"✅ Sent Q&A invitation")
                     
                 except Exception as e:
-                    print(f"❌ Error sending Q&A invitation: {e}")
+                    logger.error(f"❌ Error sending Q&A invitation: {e}")
             else:
                 # Check if we need to automatically send follow-up messages for other cases
-                await self.check_and_send_followups(message, report, conversation_history, relevant_chunks, db)
+                await self.check_and_send_followups(message, report_id, conversation_history, relevant_chunks, db)
             
-            print(f"💬 Responded to user {user.username} in report {report.id}")
+            logger.info(f"💬 Responded to user {message.author.display_name} in report {report_id}")
             
         except Exception as e:
-            print(f"Error generating response: {e}")
-            await message.reply("❌ Sorry, I encountered an error processing your question. Please try again.")
+            logger.error(f"Error generating response: {e}")
+            error_text = "❌ Sorry, I encountered an error processing your question. Please try again."
+            if placeholder is not None:
+                await placeholder.edit(content=error_text)
+            else:
+                await message.reply(error_text)
+            if user_row is not None:
+                # No reply was saved; keep the question on record on its own
+                await rollback_quietly(db)
+                try:
+                    await self.save_messages([user_row], db)
+                except SQLAlchemyError as save_error:
+                    logger.error(f"Error saving user message: {save_error}")
 
-    async def check_and_send_followups(self, message: discord.Message, report: Report, conversation_history: List[Dict[str, str]], relevant_chunks: List[str], db: Session):
+    async def check_and_send_followups(self, message: discord.Message, report_id: int, conversation_history: List[Dict[str, str]], relevant_chunks: List[str], db: Session):
         """Check conversation stage and send automatic follow-up messages"""
-        # Analyze conversation to determine stage
-        recent_messages = conversation_history[-8:]  # Look at last 8 messages
+        # Analyze conversation to determine stage: only the last 8 messages count
+        recent_messages = conversation_history[-8:]
         
         # Check if user just confirmed/corrected their diet and we need to send executive summary + recommendations
         if len(recent_messages) >= 4:
-            user_messages = [msg for msg in recent_messages if msg['role'] == 'user']
-            bot_messages = [msg for msg in recent_messages if msg['role'] == 'bot']
+            # Most recent bot message, found by scanning backwards
+            last_bot_message = next(
+                (msg['content'] for msg in reversed(recent_messages) if msg['role'] == CHAT_ROLES[MessageRole.BOT]),
+                None
+            )
             
-            # Check if we just provided an executive summary after diet confirmation
-            if len(bot_messages) >= 1:
-                last_bot_message = bot_messages[-1]['content'].lower()
+            # Look for an executive summary we haven't sent follow-ups for yet
+            if last_bot_message is not None and (
+                    EXECUTIVE_SUMMARY_PATTERN.search(last_bot_message)
+                    and not FOLLOWUP_SENT_PATTERN.search(last_bot_message)):
+                
+                logger.info(f"🎯 Detected executive summary, sending follow-ups...")
                 
-                # Look for executive summary and check if we haven't sent follow-ups yet
-                if ('executive summary' in last_bot_message and 
-                    'actionable insight' not in last_bot_message and 
-                    'feel free to ask' not in last_bot_message):
+                try:
+                    # Send one actionable insight
+                    logger.info(f"📝 Sending actionable insight...")
+                    await self.send_actionable_insight(message, report_id, conversation_history, relevant_chunks, db)
+                    logger.info(f"✅ Actionable insight sent")
                     
-                    print(f"🎯 Detected executive summary, sending follow-ups...")
+                    # Wait a moment then send Q&A invitation
+                    await asyncio.sleep(2)
+                    logger.info(f"❓ Sending Q&A invitation...")
+                    await self.send_qa_invitation(message, report_id, db)
+                    logger.info(f"✅ Q&A invitation sent")
                     
-                    try:
-                        # Send one actionable insight
-                        print(f"📝 Sending actionable insight...")
-                        await self.send_actionable_insight(message, report, conversation_history, relevant_chunks, db)
-                        print(f"✅ Actionable insight sent")
-                        
-                        # Wait a moment then send Q&A invitation
-                        import asyncio
-                        await asyncio.sleep(2)
-                        print(f"❓ Sending Q&A invitation...")
-                        await self.send_qa_invitation(message, report, db)
-                        print(f"✅ Q&A invitation sent")
-                        
-                    except Exception as e:
-                        print(f"❌ Error in follow-up messages: {e}")
-                        import traceback
-                        traceback.print_exc()
+                except Exception as e:
+                    logger.exception(f"❌ Error in follow-up messages: {e}")
 
-    async def send_recommendations(self, message: discord.Message, report: Report, conversation_history: List[Dict[str, str]], relevant_chunks: List[str], db: Session):
+    async def send_recommendations(self, message: discord.Message, report_id: int, conversation_history: List[Dict[str, str]], relevant_chunks: List[str], db: Session):
         """Send actionable recommendations as a separate message"""
         try:
-            # Create prompt specifically for recommendations
-            recommendations_prompt = "Based on the conversation history and microbiome data, provide exactly 3 specific, actionable recommendations for improving their microbiome health. Be concise and practical."
-            
-            response_data = openai_client.create_microbiome_analysis(
+            response_data = await openai_client.create_microbiome_analysis(
                 conversation_history=conversation_history,
                 relevant_chunks=relevant_chunks,
-                user_question=recommendations_prompt
+                user_question=RECOMMENDATIONS_PROMPT
             )
             
             # Ensure the response starts with the correct prefix
@@ -461,7 +959,7 @@ class BiomeBot:
             # Save to database
             await self.save_message(
                 message_id=rec_message.id,
-                report_id=report.id,
+                report_id=report_id,
                 user_id=None,
                 role=MessageRole.BOT.value,
                 content=content,
@@ -472,18 +970,16 @@ class BiomeBot:
             )
             
         except Exception as e:
-            print(f"Error sending recommendations: {e}")
+            logger.error(f"Error sending recommendations: {e}")
+            await rollback_quietly(db)
 
-    async def send_actionable_insight(self, message: discord.Message, report: Report, conversation_history: List[Dict[str, str]], relevant_chunks: List[str], db: Session):
+    async def send_actionable_insight(self, message: discord.Message, report_id: int, conversation_history: List[Dict[str, str]], relevant_chunks: List[str], db: Session):
         """Send one actionable insight as a separate message"""
         try:
-            # Create prompt for actionable insight
-            insight_prompt = "Based on the conversation history and microbiome data, provide exactly one specific, actionable insight the user can implement immediately to improve their gut health. Be concise and practical."
-            
-            response_data = openai_client.create_microbiome_analysis(
+            response_data = await openai_client.create_microbiome_analysis(
                 conversation_history=conversation_history,
                 relevant_chunks=relevant_chunks,
-                user_question=insight_prompt
+                user_question=INSIGHT_PROMPT
             )
             
             # Ensure the response starts with the correct prefix
@@ -497,7 +993,7 @@ class BiomeBot:
             # Save to database
             await self.save_message(
                 message_id=insight_message.id,
-                report_id=report.id,
+                report_id=report_id,
                 user_id=None,
                 role=MessageRole.BOT.value,
                 content=content,
@@ -508,34 +1004,52 @@ class BiomeBot:
             )
             
         except Exception as e:
-            print(f"Error sending actionable insight: {e}")
+            logger.error(f"Error sending actionable insight: {e}")
+            await rollback_quietly(db)
 
-    async def send_qa_invitation(self, message: discord.Message, report: Report, db: Session):
+    async def send_qa_invitation(self, message: discord.Message, report_id: int, db: Session):
         """Send Q&A invitation as a separate message"""
         try:
-            qa_content = "Feel free to ask any questions about your results!"
-            qa_message = await message.channel.send(qa_content)
+            qa_message = await message.channel.send(QA_INVITATION)
             
             # Save to database
             await self.save_message(
                 message_id=qa_message.id,
-                report_id=report.id,
+                report_id=report_id,
                 user_id=None,
                 role=MessageRole.BOT.value,
-                content=qa_content,
+                content=QA_INVITATION,
                 db=db
             )
             
         except Exception as e:
-            print(f"Error sending Q&A invitation: {e}")
+            logger.error(f"Error sending Q&A invitation: {e}")
+            await rollback_quietly(db)
 
 # Initialize bot instance
 biome_bot = BiomeBot()
 
+@asynccontextmanager
+async def db_session():
+    """Yield a pooled session for one Discord event and close it off the event loop"""
+    # close() returns the connection to the pool with a ROLLBACK round trip
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        await asyncio.to_thread(db.close)
+
+async def rollback_quietly(db: Session):
+    """Clear a failed transaction so the event's later queries don't hit 'transaction is aborted'"""
+    try:
+        await asyncio.to_thread(db.rollback)
+    except SQLAlchemyError as e:
+        logger.warning(f"⚠️  Rollback failed: {e}")
+
 @bot.event
 async def on_ready():
-    print(f'✅ {bot.user} is now online and ready!')
-    print(f'📊 Servers: {len(bot.guilds)}')
+    logger.info(f'✅ {bot.user} is now online and ready!')
+    logger.info(f'📊 Servers: {len(bot.guilds)}')
 
 @bot.event
 async def on_message(message: discord.Message):
@@ -543,61 +1057,78 @@ async def on_message(message: discord.Message):
     if message.author.bot:
         return
     
-    db = SessionLocal()
     try:
-        # Handle PDF uploads (when bot is mentioned)
-        if bot.user.mentioned_in(message) and message.attachments:
-            for attachment in message.attachments:
-                if attachment.filename.lower().endswith('.pdf'):
-                    if message.author.id in biome_bot.processing_users:
-                        await message.reply("⏳ I'm still processing your previous upload. Please wait a moment!")
-                        continue
-                    
-                    biome_bot.processing_users.add(message.author.id)
-                    try:
-                        await biome_bot.process_pdf_upload(message, attachment, db)
-                    finally:
-                        biome_bot.processing_users.discard(message.author.id)
-                    return
-        
-        # Handle greeting when mentioned without attachments
-        elif bot.user.mentioned_in(message):
-            await message.reply("Greetings! 🧬 Upload a microbiome report and we can get started!")
-            return
-        
-        # Handle messages in report threads
-        elif isinstance(message.channel, discord.Thread):
-            await biome_bot.handle_thread_message(message, db)
+        async with db_session() as db:
+            # Handle PDF uploads (when bot is mentioned)
+            if bot.user.mentioned_in(message) and message.attachments:
+                for attachment in message.attachments:
+                    if attachment.filename.lower().endswith('.pdf'):
+                        # Check what Discord reports about the file before downloading any of it
+                        if attachment.size > MAX_PDF_BYTES:
+                            await message.reply(f"❌ That PDF is too large. Please upload a report under {MAX_PDF_BYTES // (1024 * 1024)} MB.")
+                            continue
+                        if attachment.content_type and not attachment.content_type.startswith('application/pdf'):
+                            await message.reply("❌ That file doesn't look like a PDF. Please upload your report as a PDF.")
+                            continue
+                        
+                        # Wait for an ingest slot before taking the per-user lock, so queued
+                        # uploads don't each pin a pooled connection while they wait
+                        if biome_bot.ingest_slots.locked():
+                            await message.reply("⏳ Lots of reports are being processed right now. Yours is queued and will start shortly!")
+                        async with biome_bot.ingest_slots:
+                            async with biome_bot.user_ingest_lock(message.author.id) as acquired:
+                                if not acquired:
+                                    await message.reply("⏳ I'm still processing your previous upload. Please wait a moment!")
+                                    continue
+                                
+                                await biome_bot.process_pdf_upload(message, attachment, db)
+                        return
+            
+            # Handle greeting when mentioned without attachments
+            elif bot.user.mentioned_in(message):
+                await message.reply("Greetings! 🧬 Upload a microbiome report and we can get started!")
+                return
+            
+            # Handle messages in report threads
+            elif isinstance(message.channel, discord.Thread):
+                await biome_bot.handle_thread_message(message, db)
     
     except Exception as e:
-        print(f"Error handling message: {e}")
+        logger.error(f"Error handling message: {e}")
         await message.reply("❌ Sorry, I encountered an error. Please try again.")
-    
-    finally:
-        db.close()
 
 @bot.command(name='stats')
 async def stats_command(ctx):
     """Show bot statistics"""
-    db = SessionLocal()
     try:
-        total_reports = db.query(Report).count()
-        total_users = db.query(User).count()
-        total_messages = db.query(Message).count()
-        total_cost = db.query(func.sum(Message.cost_usd)).scalar() or 0
+        async with db_session() as db:
+            # All four aggregates as scalar subqueries: one statement, one round trip
+            stats_query = select(
+                select(func.count()).select_from(Report).scalar_subquery(),
+                select(func.count()).select_from(User).scalar_subquery(),
+                select(func.count()).select_from(Message).scalar_subquery(),
+                select(func.coalesce(func.sum(Message.cost_usd), 0)).scalar_subquery()
+            )
+            
+            total_reports, total_users, total_messages, total_cost = await asyncio.to_thread(
+                lambda: db.execute(stats_query).one()
+            )
         
         embed = discord.Embed(title="📊 BiomeAI Statistics", color=0x00ff00)
         embed.add_field(name="👥 Users", value=total_users, inline=True)
         embed.add_field(name="📄 Reports", value=total_reports, inline=True)
         embed.add_field(name="💬 Messages", value=total_messages, inline=True)
         embed.add_field(name="💰 Total Cost", value=f"${total_cost:.4f}", inline=True)
+        cache = openai_client.cache_stats()
+        embed.add_field(name="🧠 Embedding Cache",
+                        value=f"{cache['hit_rate']:.0%} hits ({cache['size']} cached, {cache['db_hits']} from DB)", inline=True)
+        embed.add_field(name="⚡ Prompt Cache",
+                        value=f"{cache['prompt_cache_rate']:.0%} of input tokens cached", inline=True)
         
         await ctx.send(embed=embed)
     
     except Exception as e:
         await ctx.send(f"❌ Error getting stats: {e}")
-    finally:
-        db.close()
 
 @bot.command(name='health')
 async def health_command(ctx):
@@ -609,7 +1140,9 @@ def run_bot():
     if not DISCORD_TOKEN:
         raise ValueError("DISCORD_TOKEN not found in environment variables")
     
-    bot.run(DISCORD_TOKEN)
+    # No discord.py handler of its own: its records go through the root queue handler
+    bot.run(DISCORD_TOKEN, log_handler=None)
 
 if __name__ == "__main__":
+    setup_logging()
     run_bot()
@@ -18,16 +18,56 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is required")
 
+# Logging
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
 # Bot Configuration
 BOT_MENTION_NAME = "biomeAI"
 MAX_CONTEXT_TOKENS = 16000  # Conservative limit for gpt-4o context window
+SUMMARY_REPORT_TOKENS = 1000  # Report text included in the executive summary prompt
+CHAT_MAX_COMPLETION_TOKENS = 600  # Reply cap per turn; prompts ask for ~800 chars, the executive summary runs longer
+SUMMARY_MAX_COMPLETION_TOKENS = 800  # Reply cap for the one-off report summary
 CHUNK_SIZE = 1000  # Characters per chunk for PDF processing
 CHUNK_OVERLAP = 200  # Overlap between chunks
 EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 512  # Shortened embeddings (model default 1536): a third of the storage and scoring work
 CHAT_MODEL = "gpt-4o"  # the newest OpenAI model is "gpt-4o" which was released May 13, 2024
 MAX_CHUNKS_PER_QUERY = 5  # Maximum relevant chunks to include in context
+MAX_HISTORY_TURNS = 20  # Most recent thread messages sent as conversation history
+THREAD_CACHE_SIZE = 10000  # Thread -> report lookups kept in memory
+HISTORY_CACHE_SIZE = 1000  # Reports whose recent history is kept in memory
+SHORT_FOLLOWUP_CHARS = 20  # Follow-ups this short reuse the previous answer's chunks
+STREAM_EDIT_INTERVAL = 1.0  # Seconds between edits of a streaming reply (Discord allows 5 edits per 5 s)
+EMBEDDING_BATCH_SIZE = 256  # Inputs per embeddings request during PDF ingestion (API max 2048)
+EMBEDDING_CONCURRENCY = 16  # Embedding batch requests in flight at once, across all uploads
+EMBEDDING_CACHE_SIZE = 4096  # Query and chunk embeddings kept in the in-memory LRU
+OPENAI_MAX_CONNECTIONS = 200  # Pooled HTTP connections to the OpenAI API
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 100  # Idle connections kept open for reuse
+OPENAI_KEEPALIVE_EXPIRY = 60  # Seconds an idle connection is kept (httpx default 5 s drops them between messages)
+OPENAI_CONNECT_RETRIES = 2  # Retries for failed connection attempts (not for failed requests)
+OPENAI_MAX_RETRIES = 5  # SDK retries for rate limits, timeouts and 5xx responses (default 2)
+CHUNK_INSERT_PAGE_SIZE = 500  # Report chunk rows per multi-row INSERT statement
+PDF_PROCESS_WORKERS = os.cpu_count() or 1  # Worker processes parsing uploaded PDFs
+PDF_PAGES_PER_TASK = 8  # Minimum pages per extraction task when a long PDF is split across workers
+PDF_INGEST_CONCURRENCY = 4  # PDF uploads processed at once; later uploads wait their turn
+MAX_PDF_BYTES = 25 * 1024 * 1024  # Larger uploads are rejected before download
+PDF_SPOOL_BYTES = 5 * 1024 * 1024  # Larger uploads are saved to a temp file and memory-mapped
+REPORT_VECTOR_MAX_CHUNKS = 2000  # Reports up to this size are ranked in memory instead of via pgvector
+REPORT_VECTOR_CACHE_BYTES = 64 * 1024 * 1024  # RAM budget for in-memory (int8) report embedding matrices
+
+# Vector index configuration (pgvector HNSW)
+HNSW_M = 24  # Graph connections per node
+HNSW_EF_CONSTRUCTION = 128  # Candidate list size while building the index
+HNSW_EF_SEARCH = 100  # Candidate list size per query (higher = better recall, slower)
+
+# Semantic response cache (Q&A stage only). Truncated embeddings keep the coarse,
+# topic-level dimensions, so distinct questions about the same taxon score closer at
+# EMBEDDING_DIMENSIONS than at 1536: the bar is higher than the 0.95 used there.
+SEMANTIC_CACHE_MIN_SIMILARITY = 0.97  # Cosine similarity needed to reuse a past answer
 
 # Cost tracking (approximate costs per 1K tokens)
 EMBEDDING_COST_PER_1K = 0.00002  # text-embedding-3-small
 GPT4O_INPUT_COST_PER_1K = 0.0025
+GPT4O_CACHED_INPUT_COST_PER_1K = 0.00125  # Input tokens served from OpenAI's prompt cache
 GPT4O_OUTPUT_COST_PER_1K = 0.01
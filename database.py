@@ -1,8 +1,11 @@
 import os
+import logging
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import DeclarativeBase, sessionmaker
 from sqlalchemy.pool import QueuePool
 
+logger = logging.getLogger(__name__)
+
 class Base(DeclarativeBase):
     pass
 
@@ -11,18 +14,55 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is required")
 
+# Blocking queries run on asyncio's default thread pool (up to 32 workers), and each
+# in-flight PDF ingest also pins one connection for its advisory lock; size the pool
+# so neither has to wait on a checkout. A handler's session also keeps its connection
+# from its first query until it commits, which can span an OpenAI call, so the pool
+# tracks concurrent conversations rather than busy threads and is not cut back to
+# the thread count. LIFO checkout reuses the most recently used (warm) connections,
+# so under light load the rest sit idle and age out instead of being cycled through.
+# pre_ping catches dead connections, so recycling only needs to outlive server/proxy
+# idle timeouts.
 engine = create_engine(
     DATABASE_URL,
     poolclass=QueuePool,
-    pool_size=10,
-    max_overflow=20,
-    pool_recycle=300,
+    pool_size=20,
+    max_overflow=30,
+    pool_use_lifo=True,
+    pool_recycle=3600,
     pool_pre_ping=True,
     echo=False
 )
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Tables reset_database() leaves in place
+PERSISTENT_TABLES = {"embedding_cache"}
+
+# halfvec columns need pgvector 0.7; hnsw.iterative_scan (set on every retrieval) needs 0.8
+MIN_PGVECTOR_VERSION = (0, 8)
+
+def enable_pgvector():
+    """Create the pgvector extension and check it is new enough for the retrieval settings"""
+    with engine.connect() as conn:
+        try:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
+            version = conn.execute(
+                text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+            ).scalar()
+            conn.commit()
+        except Exception as e:
+            logger.error(f"❌ pgvector extension setup failed: {e}")
+            raise RuntimeError("The pgvector extension is required") from e
+    
+    # Fail at startup rather than on every retrieval transaction
+    if tuple(int(part) for part in version.split(".")[:2]) < MIN_PGVECTOR_VERSION:
+        raise RuntimeError(
+            f"pgvector {version} is too old; {'.'.join(map(str, MIN_PGVECTOR_VERSION))} or newer is required "
+            "(ALTER EXTENSION vector UPDATE)"
+        )
+    logger.info(f"✅ pgvector extension enabled (version {version})")
+
 def get_db():
     """Get database session"""
     db = SessionLocal()
@@ -35,38 +75,28 @@ def reset_database():
     """Drop all tables and recreate them for a fresh start"""
     from models import User, Report, ReportChunk, Message
     
-    print("🔄 Resetting database...")
+    logger.info("🔄 Resetting database...")
     
-    # Drop all tables
-    Base.metadata.drop_all(bind=engine)
-    print("✅ All tables dropped")
+    # Drop all tables except content-addressed caches, which stay valid across resets
+    Base.metadata.drop_all(bind=engine, tables=[
+        table for table in Base.metadata.sorted_tables if table.name not in PERSISTENT_TABLES
+    ])
+    logger.info("✅ All tables dropped (embedding cache kept)")
     
-    # Create pgvector extension
-    with engine.connect() as conn:
-        try:
-            conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
-            conn.commit()
-            print("✅ pgvector extension enabled")
-        except Exception as e:
-            print(f"⚠️  pgvector extension setup: {e}")
+    # Create pgvector extension (required: retrieval has no non-vector fallback)
+    enable_pgvector()
     
     # Create all tables
     Base.metadata.create_all(bind=engine)
-    print("✅ Database tables created")
+    logger.info("✅ Database tables created")
 
 def init_database():
     """Initialize database tables and extensions"""
     from models import User, Report, ReportChunk, Message
     
-    # Create pgvector extension
-    with engine.connect() as conn:
-        try:
-            conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
-            conn.commit()
-            print("✅ pgvector extension enabled")
-        except Exception as e:
-            print(f"⚠️  pgvector extension setup: {e}")
+    # Create pgvector extension (required: retrieval has no non-vector fallback)
+    enable_pgvector()
     
     # Create all tables
     Base.metadata.create_all(bind=engine)
-    print("✅ Database tables created")
+    logger.info("✅ Database tables created")
@@ -5,6 +5,7 @@ A Discord bot that analyzes microbiome PDF reports using RAG and OpenAI
 """
 
 import asyncio
+import logging
 import sys
 import os
 from pathlib import Path
@@ -13,9 +14,11 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent))
 
 from database import init_database, reset_database
-from bot import run_bot
+from bot import run_bot, setup_logging
 from config import DISCORD_TOKEN, OPENAI_API_KEY, DATABASE_URL
 
+logger = logging.getLogger(__name__)
+
 def check_environment():
     """Check that all required environment variables are set"""
     required_vars = {
@@ -30,38 +33,37 @@ def check_environment():
             missing_vars.append(var_name)
     
     if missing_vars:
-        print("❌ Missing required environment variables:")
-        for var in missing_vars:
-            print(f"   - {var}")
-        print("\nPlease set these environment variables and try again.")
+        logger.error("❌ Missing required environment variables: " + ", ".join(missing_vars))
+        logger.error("Please set these environment variables and try again.")
         sys.exit(1)
     
-    print("✅ Environment variables configured")
+    logger.info("✅ Environment variables configured")
 
 def main():
     """Main entry point"""
-    print("🧬 Starting BiomeAI Discord Bot...")
+    setup_logging()
+    logger.info("🧬 Starting BiomeAI Discord Bot...")
     
     # Check environment
     check_environment()
     
     # Reset database for fresh start
-    print("📊 Resetting database...")
+    logger.info("📊 Resetting database...")
     try:
         reset_database()
-        print("✅ Database reset successfully")
+        logger.info("✅ Database reset successfully")
     except Exception as e:
-        print(f"❌ Database reset failed: {e}")
+        logger.error(f"❌ Database reset failed: {e}")
         sys.exit(1)
     
     # Start bot
-    print("🤖 Starting Discord bot...")
+    logger.info("🤖 Starting Discord bot...")
     try:
         run_bot()
     except KeyboardInterrupt:
-        print("\n👋 Bot stopped by user")
+        logger.info("👋 Bot stopped by user")
     except Exception as e:
-        print(f"❌ Bot error: {e}")
+        logger.error(f"❌ Bot error: {e}")
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -1,14 +1,25 @@
-from sqlalchemy import Column, Integer, BigInteger, String, Text, DateTime, Boolean, Numeric, ForeignKey, JSON, Index
+from sqlalchemy import Column, Integer, SmallInteger, BigInteger, String, Text, DateTime, Boolean, Numeric, ForeignKey, Index, Enum
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
-from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, REAL
+from pgvector.sqlalchemy import HALFVEC
 from database import Base
+from config import HNSW_M, HNSW_EF_CONSTRUCTION, EMBEDDING_DIMENSIONS
 import enum
 
 class MessageRole(enum.Enum):
     USER = "user"
     BOT = "bot"
 
+class ConversationStage(enum.IntEnum):
+    """Conversation progress for a report, stored as a smallint"""
+    INITIAL = 0
+    DIET_PREDICTION = 1
+    ENERGY_PREDICTION = 2
+    DIGESTIVE_PREDICTION = 3
+    EXECUTIVE_SUMMARY = 4
+    QA = 5
+
 class User(Base):
     __tablename__ = "users"
     
@@ -26,27 +37,31 @@ class Report(Base):
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(BigInteger, ForeignKey("users.id"), nullable=False)
-    thread_id = Column(BigInteger, nullable=False, unique=True)  # Discord thread ID
+    thread_id = Column(BigInteger, nullable=False, unique=True)  # Discord thread ID (unique constraint doubles as the lookup index)
     original_filename = Column(String(255))
     sample_date = Column(DateTime(timezone=True))
-    report_metadata = Column(JSON, default=dict)  # Store additional info like user details
-    conversation_stage = Column(String(50), default="initial")  # Track conversation progress
+    report_metadata = Column(JSONB, default=dict)  # Store additional info like user details (JSONB for jsonb_set/field access)
+    conversation_stage = Column(SmallInteger, default=ConversationStage.INITIAL)  # Track conversation progress
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
     # Relationships
     user = relationship("User", back_populates="reports")
-    chunks = relationship("ReportChunk", back_populates="report", cascade="all, delete-orphan")
-    messages = relationship("Message", back_populates="report", cascade="all, delete-orphan")
+    # passive_deletes: let the ON DELETE CASCADE foreign keys remove children in the same
+    # statement instead of loading every chunk (and its embedding) to delete it row by row
+    chunks = relationship("ReportChunk", back_populates="report", cascade="all, delete-orphan",
+                          passive_deletes=True)
+    messages = relationship("Message", back_populates="report", cascade="all, delete-orphan",
+                            passive_deletes=True)
 
 class ReportChunk(Base):
     __tablename__ = "report_chunks"
     
     id = Column(Integer, primary_key=True, autoincrement=True)
-    report_id = Column(Integer, ForeignKey("reports.id"), nullable=False)
+    report_id = Column(Integer, ForeignKey("reports.id", ondelete="CASCADE"), nullable=False)
     chunk_idx = Column(Integer, nullable=False)  # Order of chunk in document
     content = Column(Text, nullable=False)
-    # Note: pgvector column will be added dynamically based on available extensions
+    # Note: the pgvector embedding column is added below the model classes
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relationships
@@ -60,9 +75,12 @@ class Message(Base):
     __tablename__ = "messages"
     
     id = Column(BigInteger, primary_key=True)  # Discord message ID
-    report_id = Column(Integer, ForeignKey("reports.id"), nullable=False)
+    report_id = Column(Integer, ForeignKey("reports.id", ondelete="CASCADE"), nullable=False)
     user_id = Column(BigInteger, ForeignKey("users.id"), nullable=True)  # Null for bot messages
-    role = Column(String(10), nullable=False)  # 'user' or 'bot'
+    # Native Postgres enum: fixed-size storage, values stay 'user' / 'bot'
+    role = Column(Enum(MessageRole, name="message_role",
+                       values_callable=lambda roles: [role.value for role in roles]),
+                  nullable=False)
     content = Column(Text, nullable=False)
     
     # Token and cost tracking
@@ -81,26 +99,49 @@ class Message(Base):
     
     __table_args__ = (
         Index('messages_report_created_idx', 'report_id', 'created_at'),
+        # Serves the per-turn history fetch (WHERE report_id = ? ORDER BY id DESC LIMIT n)
         Index('messages_thread_order_idx', 'report_id', 'id'),
     )
 
-# Add pgvector column if extension is available
-try:
-    from pgvector.sqlalchemy import Vector
+class SemanticCacheEntry(Base):
+    """A past Q&A answer, reused when the same report gets a near-identical question"""
+    __tablename__ = "semantic_cache"
     
-    # Add embedding column to ReportChunk
-    ReportChunk.embedding = Column(Vector(1536))  # OpenAI embedding dimension
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    report_id = Column(Integer, ForeignKey("reports.id", ondelete="CASCADE"), nullable=False)
+    response_text = Column(Text, nullable=False)
+    # Note: query embedding column is added with the other pgvector columns below
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
     
-    # Create vector index
-    ReportChunk.__table_args__ = (
-        Index('report_chunks_report_idx', 'report_id'),
-        Index('report_chunks_embedding_idx', 'embedding', postgresql_using='ivfflat',
-              postgresql_with={'lists': 100}, postgresql_ops={'embedding': 'vector_cosine_ops'}),
+    __table_args__ = (
+        # Lookups scan one report's handful of entries exactly; no ANN index needed
+        Index('semantic_cache_report_idx', 'report_id'),
     )
+
+class EmbeddingCacheEntry(Base):
+    """Content-addressed embedding shared by every bot process; survives database resets"""
+    __tablename__ = "embedding_cache"
     
-    print("✅ pgvector columns and indexes configured")
-    
-except ImportError:
-    print("⚠️  pgvector not available, using fallback storage")
-    # Fallback to array storage
-    ReportChunk.embedding_array = Column(ARRAY(Numeric), nullable=True)
+    key = Column(String(64), primary_key=True)  # sha256 hex of model + dimensions + exact text
+    # Only ever fetched by key, so a plain float array (full float32 precision) rather than a vector
+    embedding = Column(ARRAY(REAL), nullable=False)  # Unit-normalized
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+# pgvector columns and indexes. pgvector is required: retrieval depends on its
+# native nearest-neighbour search, and there is no Python ranking fallback.
+# Half-precision storage (pgvector >= 0.7): half the bytes per row and per
+# index page, with negligible effect on similarity ranking
+ReportChunk.embedding = Column(HALFVEC(EMBEDDING_DIMENSIONS))
+
+# Create vector index. Binding it to the column attaches it to the table;
+# reassigning __table_args__ after the class is mapped has no effect.
+# HNSW rather than ivfflat: the table is created empty at startup, and
+# ivfflat builds its lists from the rows present at index creation time.
+# Embeddings are stored unit-normalized, so inner product ranks the same as
+# cosine distance without the per-row norm computation.
+Index('report_chunks_embedding_idx', ReportChunk.embedding, postgresql_using='hnsw',
+      postgresql_with={'m': HNSW_M, 'ef_construction': HNSW_EF_CONSTRUCTION},
+      postgresql_ops={'embedding': 'halfvec_ip_ops'})
+
+# Query embedding for the semantic response cache (unit-normalized, like chunks)
+SemanticCacheEntry.query_embedding = Column(HALFVEC(EMBEDDING_DIMENSIONS))
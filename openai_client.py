@@ -1,127 +1,113 @@
-import json
-import os
+import asyncio
+import hashlib
+import httpx
+import logging
 import numpy as np
-from typing import List, Dict, Any
-from openai import OpenAI
-from config import (OPENAI_API_KEY, EMBEDDING_MODEL, CHAT_MODEL,
-                    MAX_CONTEXT_TOKENS, EMBEDDING_COST_PER_1K,
-                    GPT4O_INPUT_COST_PER_1K, GPT4O_OUTPUT_COST_PER_1K)
-
-
-class OpenAIClient:
-
-    def __init__(self):
-        self.client = OpenAI(api_key=OPENAI_API_KEY)
-
-    def get_embedding(self, text: str) -> List[float]:
-        """Get embedding for text using OpenAI's embedding model"""
-        try:
-            response = self.client.embeddings.create(model=EMBEDDING_MODEL,
-                                                     input=text)
-            return response.data[0].embedding
-        except Exception as e:
-            print(f"Error getting embedding: {e}")
-            raise
-
-    def calculate_embedding_cost(self, text: str) -> float:
-        """Calculate approximate cost for embedding generation"""
-        # Rough token count estimation
-        token_count = len(text.split()) * 1.3  # Approximate tokens
-        return (token_count / 1000) * EMBEDDING_COST_PER_1K
-
-    def calculate_chat_cost(self, input_tokens: int,
-                            output_tokens: int) -> float:
-        """Calculate cost for chat completion"""
-        input_cost = (input_tokens / 1000) * GPT4O_INPUT_COST_PER_1K
-        output_cost = (output_tokens / 1000) * GPT4O_OUTPUT_COST_PER_1K
-        return input_cost + output_cost
-
-    def count_tokens_rough(self, text: str) -> int:
-        """Rough token count estimation"""
-        return int(len(text.split()) * 1.3)
-
-    def create_microbiome_analysis(
-            self,
-            conversation_history: List[Dict[str, str]],
-            relevant_chunks: List[str],
-            user_question: str = None) -> Dict[str, Any]:
-        """
-        Create microbiome analysis using conversation history and relevant chunks
-        
-        Args:
-            conversation_history: List of previous messages in thread
-            relevant_chunks: Relevant PDF chunks from RAG
-            user_question: Current user question (if any)
-        
-        Returns:
-            Dict with response content, token usage, and cost
-        """
-
-        # Analyze conversation history to determine stage
-        if len(conversation_history) < 2:
-            # General response for early conversation
-            system_prompt = """You are BiomeAI, an expert microbiome analyst assistant. 
-
-Answer the user's question about their microbiome report using the provided context. Be specific, reference their actual data, and provide actionable insights.
-
-Keep responses focused and under 800 characters. Reference specific bacteria and metrics from their report when relevant."""
-        else:
-            # Look at the last few messages to determine conversation stage
-            last_4_messages = conversation_history[-4:] if len(
-                conversation_history) >= 4 else conversation_history
-            recent_content = " ".join(
-                [msg["content"].lower() for msg in last_4_messages])
-
-            # Check if this is diet prediction stage (after antibiotics question)
-            if any(
-                    keyword in recent_content
-                    for keyword in ["antibiotic", "medication", "supplement"]
-            ) and user_question and "does this match your actual diet" not in recent_content:
-                # Diet prediction stage
-                system_prompt = """You are BiomeAI, an expert microbiome analyst. 
-
-Your task: Predict the user's diet based on their microbiome report. Be concise and direct.
+from collections import OrderedDict
+from functools import lru_cache
+from string import Template
+from typing import List, Dict, Any, Awaitable, Callable, Optional
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from database import SessionLocal
+from models import ConversationStage, EmbeddingCacheEntry
+from config import (OPENAI_API_KEY, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS, CHAT_MODEL,
+                    MAX_CONTEXT_TOKENS, EMBEDDING_BATCH_SIZE,
+                    EMBEDDING_CACHE_SIZE, EMBEDDING_CONCURRENCY,
+                    EMBEDDING_COST_PER_1K, OPENAI_MAX_CONNECTIONS,
+                    OPENAI_MAX_KEEPALIVE_CONNECTIONS, OPENAI_KEEPALIVE_EXPIRY,
+                    OPENAI_CONNECT_RETRIES, OPENAI_MAX_RETRIES, SUMMARY_REPORT_TOKENS,
+                    CHAT_MAX_COMPLETION_TOKENS, SUMMARY_MAX_COMPLETION_TOKENS,
+                    GPT4O_INPUT_COST_PER_1K, GPT4O_CACHED_INPUT_COST_PER_1K,
+                    GPT4O_OUTPUT_COST_PER_1K)
+
+logger = logging.getLogger(__name__)
+
+# Exact token counts when tiktoken is installed; rough character-based estimates otherwise
+try:
+    import tiktoken
+    _ENCODING = tiktoken.encoding_for_model(CHAT_MODEL)
+except ImportError:
+    _ENCODING = None
+    logger.warning("⚠️  tiktoken not available, using rough token estimates")
+except Exception as e:
+    # The encoding's BPE file is fetched on first use and may be unreachable
+    _ENCODING = None
+    logger.warning(f"⚠️  tiktoken encoding unavailable ({e}), using rough token estimates")
+
+TOKENS_PER_MESSAGE = 4  # Chat format overhead per message (role and delimiters)
+
+
+@lru_cache(maxsize=4096)
+def _count_tokens(text: str) -> int:
+    """Token count for text, cached: system prompts and history repeat on every turn"""
+    if _ENCODING is None:
+        # ~4 characters per token; word counts badly undercount the numeric tables
+        # and Latin taxon names that make up much of a report
+        return (len(text) + 3) // 4
+    # Special-token text in user content is counted as plain text, not rejected
+    return len(_ENCODING.encode(text, disallowed_special=()))
+
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to at most max_tokens tokens (about 4 characters per token without tiktoken)"""
+    if _ENCODING is None:
+        return text[:max_tokens * 4]
+    tokens = _ENCODING.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return _ENCODING.decode(tokens[:max_tokens])
+
+
+# Report context message: "Report Section: " before each retrieved chunk
+REPORT_CONTEXT_PREFIX = "Here are relevant sections from the user's microbiome report:\n\nReport Section: "
+REPORT_SECTION_SEPARATOR = "\n\nReport Section: "
+
+# Identical first message on every chat call. OpenAI caches repeated prompt prefixes
+# (billed at half price, served faster), so everything that stays the same from turn
+# to turn comes first: this prompt, then the thread's history, which only grows.
+# Whatever changes per turn (stage instructions, retrieved report sections, the
+# question) goes after it, at the end of the message list.
+BASE_SYSTEM_PROMPT = "You are BiomeAI, an expert microbiome analyst assistant."
+
+# Instructions for each conversation stage, sent after the history
+SYSTEM_PROMPTS: Dict[ConversationStage, str] = {
+    # General response for early conversation
+    ConversationStage.INITIAL: """Answer the user's question about their microbiome report using the provided context. Be specific, reference their actual data, and provide actionable insights.
+
+Keep responses focused and under 800 characters. Reference specific bacteria and metrics from their report when relevant.""",
+
+    # Diet prediction stage
+    ConversationStage.DIET_PREDICTION: """Your task: Predict the user's diet based on their microbiome report. Be concise and direct.
 
 Your response should:
 1. Briefly predict specific foods/diet patterns they likely eat (be concrete but short - mention 2-3 specific food types or patterns)
 3. End with: "Does this match your actual diet? If no, describe what kind of diet you normally eat and also if you have any allergies?"
 
-Keep it short and to the point."""
+Keep it short and to the point.""",
 
-            # Check if user just responded to diet question (need energy prediction)
-            elif "does this match your actual diet" in recent_content and user_question and "energy levels" not in recent_content and "digestive issues" not in recent_content:
-                # Energy prediction stage
-                system_prompt = """You are BiomeAI, an expert microbiome analyst.
-
-Based on your microbiome, predict your likely energy levels. Be concise and direct.
+    # Energy prediction stage
+    ConversationStage.ENERGY_PREDICTION: """Based on your microbiome, predict your likely energy levels. Be concise and direct.
 
 Your response should:
 1. Predict their energy state (high energy, low energy, afternoon crashes, etc.)
 2. End with: "Does this match your energy levels? Please describe your typical energy throughout the day."
 
-Keep it short and to the point."""
-
-            # Check if user responded to energy question (need digestive prediction)
-            elif "energy levels" in recent_content and "does this match your energy levels" in recent_content and user_question and "digestive issues" not in recent_content:
-                # Digestive prediction stage
-                system_prompt = """You are BiomeAI, an expert microbiome analyst.
+Keep it short and to the point.""",
 
-Based on your microbiome, predict your likely digestive issues. Be concise and direct.
+    # Digestive prediction stage
+    ConversationStage.DIGESTIVE_PREDICTION: """Based on your microbiome, predict your likely digestive issues. Be concise and direct.
 
 Your response should:
 1. Predict digestive symptoms (bloating, gas, bowel movement patterns, etc.)
 2. End with: "Is this accurate? Please describe any digestive issues you experience."
 
-Keep it short and to the point."""
+Keep it short and to the point.""",
 
-            # Check if user responded to digestive question (need executive summary)
-            elif ("is this accurate" in recent_content
-                  and "digestive issues you experience"
-                  in recent_content) and user_question:
-                # Executive summary stage - this will trigger automatic follow-ups
-                system_prompt = """You are BiomeAI, an expert microbiome analyst.
-
-Your task: Provide an executive summary combining the microbiome report with the user's confirmed diet, energy, and digestive information.
+    # Executive summary stage - this will trigger automatic follow-ups
+    ConversationStage.EXECUTIVE_SUMMARY: """Your task: Provide an executive summary combining the microbiome report with the user's confirmed diet, energy, and digestive information.
 
 Your response MUST start with: "Executive Summary of microbiome report and lifestyle:"
 
@@ -132,13 +118,10 @@ Then provide a comprehensive summary covering:
 - Overall gut health assessment
 - Call to action with actionable insights
 
-Keep it focused and informative."""
+Keep it focused and informative.""",
 
-            else:
-                # General Q&A stage
-                system_prompt = """You are BiomeAI, an expert microbiome analyst assistant. 
-
-Answer the user's question about their microbiome report using the provided context. 
+    # General Q&A stage
+    ConversationStage.QA: """Answer the user's question about their microbiome report using the provided context. 
 
 Your job is to give clear, safe, actionable advice in human language. Never pretend to be a doctor. Never make strong claims. Help users learn, reflect, and take small steps toward better gut health.
 
@@ -183,62 +166,387 @@ Avoid fake cheer. Stay grounded.
 
 No “You’re amazing!”—use: “Good input. Let’s build on it.”
 
-Keep responses focused and under 800 characters. """
+Keep responses focused and under 800 characters. """,
+}
+
+# Token counts for the prompts above, so only a turn's variable content is counted per call
+SYSTEM_PROMPT_TOKENS: Dict[ConversationStage, int] = {
+    stage: _count_tokens(BASE_SYSTEM_PROMPT) + _count_tokens(prompt) + 2 * TOKENS_PER_MESSAGE
+    for stage, prompt in SYSTEM_PROMPTS.items()
+}
+
+# One-off report summary prompt; only the lifestyle context and report excerpt vary
+SUMMARY_PROMPT_TEMPLATE = Template("""Analyze this microbiome report and provide an executive summary with actionable insights.
+
+User Lifestyle Context:
+$lifestyle_context
+
+Microbiome Report Content:
+$report_excerpt
+
+Please provide:
+1. Key findings from the report
+2. Notable patterns or concerns
+3. Personalized recommendations based on their lifestyle
+4. One specific actionable next step they could consider
+
+Keep the response engaging and supportive, focusing on practical insights.""")
+
+
+class OpenAIClient:
+
+    def __init__(self):
+        # Async only: every caller is a Discord handler, so requests never block the event loop.
+        # One process-wide client keeps a keep-alive pool, so API calls reuse TLS connections.
+        # An explicit transport carries the pool limits (httpx ignores client-level limits
+        # once a transport is given) and retries failed connection attempts.
+        # The SDK retries rate limits, timeouts, connection errors and 5xx responses with
+        # jittered exponential backoff (honouring Retry-After); 400/401-style errors fail at once.
+        self.async_client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            max_retries=OPENAI_MAX_RETRIES,
+            http_client=DefaultAsyncHttpxClient(
+                transport=httpx.AsyncHTTPTransport(
+                    retries=OPENAI_CONNECT_RETRIES,
+                    limits=httpx.Limits(
+                        max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY))))
+        # LRU of embeddings keyed by a hash of the model and exact text.
+        # Held as float16 arrays (3 KB per vector instead of ~48 KB of Python floats);
+        # pgvector stores them as halfvec anyway, so no precision is lost downstream
+        self._embedding_cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._db_hits = 0  # LRU misses answered by the shared embedding_cache table
+        # Chat input tokens, and how many of them OpenAI served from its prompt cache
+        self._prompt_tokens = 0
+        self._cached_prompt_tokens = 0
+        # Shared by every batch call, so concurrent uploads can't stampede the API together
+        self._embedding_semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+
+    async def close(self):
+        """Close the pooled HTTP connections"""
+        await self.async_client.close()
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        """Scale an embedding to unit length (in float32) and store it as float16"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.astype(np.float16)
+
+    @staticmethod
+    def _embedding_cache_key(text: str) -> str:
+        """Hash the model, dimensions and exact text: case and spacing can change the embedding"""
+        # "|" rather than the NUL separator of the old lowercased keys, whose stored
+        # embeddings may belong to a differently-cased text and must never match
+        return hashlib.sha256(
+            f"{EMBEDDING_MODEL}|{EMBEDDING_DIMENSIONS}|{text}".encode("utf-8")).hexdigest()
+
+    def _cache_get(self, cache_key: str):
+        """Return a cached embedding (marking it recently used) or None"""
+        cached = self._embedding_cache.get(cache_key)
+        if cached is None:
+            self._cache_misses += 1
+            return None
+        self._cache_hits += 1
+        self._embedding_cache.move_to_end(cache_key)
+        return cached
+
+    def _cache_put(self, cache_key: str, embedding: np.ndarray):
+        """Store an embedding, evicting the least recently used entry when full"""
+        self._embedding_cache[cache_key] = embedding
+        self._embedding_cache.move_to_end(cache_key)
+        if len(self._embedding_cache) > EMBEDDING_CACHE_SIZE:
+            self._embedding_cache.popitem(last=False)
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Embedding cache size and hit rate since startup"""
+        lookups = self._cache_hits + self._cache_misses
+        return {
+            'size': len(self._embedding_cache),
+            'hits': self._cache_hits,
+            'misses': self._cache_misses,
+            'hit_rate': self._cache_hits / lookups if lookups else 0.0,
+            'db_hits': self._db_hits,
+            'prompt_cache_rate': (self._cached_prompt_tokens / self._prompt_tokens
+                                  if self._prompt_tokens else 0.0)
+        }
+
+    async def _load_persisted(self,
+                              cache_keys: List[str]) -> Dict[str, np.ndarray]:
+        """Fetch embeddings stored by any bot process; a failed lookup counts as a miss"""
+
+        def load():
+            with SessionLocal() as db:
+                return db.query(EmbeddingCacheEntry.key,
+                                EmbeddingCacheEntry.embedding).filter(
+                                    EmbeddingCacheEntry.key.in_(
+                                        cache_keys)).all()
+
+        try:
+            rows = await asyncio.to_thread(load)
+        except SQLAlchemyError as e:
+            logger.warning(f"⚠️  Embedding cache lookup failed: {e}")
+            return {}
+
+        self._db_hits += len(rows)
+        return {key: np.asarray(embedding, dtype=np.float16) for key, embedding in rows}
+
+    async def _persist(self, entries: Dict[str, np.ndarray]):
+        """Share fresh embeddings with other processes and future restarts"""
+
+        def save():
+            with SessionLocal() as db:
+                db.execute(
+                    insert(EmbeddingCacheEntry).on_conflict_do_nothing(
+                        index_elements=["key"]),
+                    [{
+                        "key": key,
+                        "embedding": embedding.tolist()  # psycopg2 adapts lists, not arrays
+                    } for key, embedding in entries.items()])
+                db.commit()
+
+        try:
+            await asyncio.to_thread(save)
+        except SQLAlchemyError as e:
+            logger.warning(f"⚠️  Embedding cache write failed: {e}")
+
+    async def aget_embedding(self, text: str) -> np.ndarray:
+        """Get embedding for text using OpenAI's embedding model"""
+        cache_key = self._embedding_cache_key(text)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
 
-        # Prepare messages
-        messages = [{"role": "system", "content": system_prompt}]
+        persisted = await self._load_persisted([cache_key])
+        if cache_key in persisted:
+            self._cache_put(cache_key, persisted[cache_key])
+            return persisted[cache_key]
+
+        try:
+            response = await self.async_client.embeddings.create(
+                model=EMBEDDING_MODEL, input=text, dimensions=EMBEDDING_DIMENSIONS)
+            embedding = self._normalize(response.data[0].embedding)
+        except Exception as e:
+            logger.error(f"Error getting embedding: {e}")
+            raise
+
+        self._cache_put(cache_key, embedding)
+        await self._persist({cache_key: embedding})
+        return embedding
+
+    async def aget_embeddings_batch(self,
+                                    texts: List[str]) -> List[np.ndarray]:
+        """Get embeddings for many texts, sending only cache misses in concurrent batches"""
+        cache_keys = [self._embedding_cache_key(text) for text in texts]
+        embeddings = {}
+        uncached = {}  # cache key -> text, deduplicated within this call
+        for cache_key, text in zip(cache_keys, texts):
+            if cache_key in embeddings or cache_key in uncached:
+                continue
+            cached = self._cache_get(cache_key)
+            if cached is not None:
+                embeddings[cache_key] = cached
+            else:
+                uncached[cache_key] = text
+
+        if uncached:
+            persisted = await self._load_persisted(list(uncached))
+            for cache_key, embedding in persisted.items():
+                self._cache_put(cache_key, embedding)
+                embeddings[cache_key] = embedding
+                del uncached[cache_key]
+
+        async def embed_batch(batch: List[str]) -> List[np.ndarray]:
+            async with self._embedding_semaphore:
+                response = await self.async_client.embeddings.create(
+                    model=EMBEDDING_MODEL, input=batch,
+                    dimensions=EMBEDDING_DIMENSIONS)
+            # Results carry their input index; keep them in input order
+            ordered = sorted(response.data, key=lambda item: item.index)
+            return [self._normalize(item.embedding) for item in ordered]
+
+        missing_keys = list(uncached)
+        missing_texts = list(uncached.values())
+        batches = [
+            missing_texts[start:start + EMBEDDING_BATCH_SIZE]
+            for start in range(0, len(missing_texts), EMBEDDING_BATCH_SIZE)
+        ]
+        try:
+            results = await asyncio.gather(*(embed_batch(batch)
+                                             for batch in batches))
+        except Exception as e:
+            logger.error(f"Error getting batch embeddings: {e}")
+            raise
+
+        fresh = [embedding for batch in results for embedding in batch]
+        for cache_key, embedding in zip(missing_keys, fresh):
+            self._cache_put(cache_key, embedding)
+            embeddings[cache_key] = embedding
+        if missing_keys:
+            await self._persist(dict(zip(missing_keys, fresh)))
+
+        return [embeddings[cache_key] for cache_key in cache_keys]
+
+    def calculate_embedding_cost(self, text: str) -> float:
+        """Calculate approximate cost for embedding generation"""
+        token_count = _count_tokens(text)  # Chat model encoding; close enough for an estimate
+        return (token_count / 1000) * EMBEDDING_COST_PER_1K
+
+    def calculate_chat_cost(self, input_tokens: int,
+                            output_tokens: int,
+                            cached_tokens: int = 0) -> float:
+        """Calculate cost for chat completion (cached input tokens are billed at a discount)"""
+        input_cost = ((input_tokens - cached_tokens) / 1000) * GPT4O_INPUT_COST_PER_1K
+        input_cost += (cached_tokens / 1000) * GPT4O_CACHED_INPUT_COST_PER_1K
+        output_cost = (output_tokens / 1000) * GPT4O_OUTPUT_COST_PER_1K
+        return input_cost + output_cost
+
+    def count_tokens(self, text: str) -> int:
+        """Token count under the chat model's encoding (rough estimate without tiktoken)"""
+        return _count_tokens(text)
+
+    @staticmethod
+    def determine_stage(conversation_history: List[Dict[str, str]],
+                        user_question: str = None) -> ConversationStage:
+        """Work out which scripted step the conversation is on from its recent messages"""
+        if len(conversation_history) < 2:
+            return ConversationStage.INITIAL
+
+        # Look at the last few messages to determine conversation stage
+        recent_content = " ".join(
+            [msg["content"].lower() for msg in conversation_history[-4:]])
+
+        # Check if this is diet prediction stage (after antibiotics question)
+        if any(keyword in recent_content
+               for keyword in ["antibiotic", "medication", "supplement"]
+               ) and user_question and "does this match your actual diet" not in recent_content:
+            return ConversationStage.DIET_PREDICTION
+
+        # Check if user just responded to diet question (need energy prediction)
+        if "does this match your actual diet" in recent_content and user_question and "energy levels" not in recent_content and "digestive issues" not in recent_content:
+            return ConversationStage.ENERGY_PREDICTION
+
+        # Check if user responded to energy question (need digestive prediction)
+        if "energy levels" in recent_content and "does this match your energy levels" in recent_content and user_question and "digestive issues" not in recent_content:
+            return ConversationStage.DIGESTIVE_PREDICTION
+
+        # Check if user responded to digestive question (need executive summary)
+        if ("is this accurate" in recent_content
+                and "digestive issues you experience"
+                in recent_content) and user_question:
+            return ConversationStage.EXECUTIVE_SUMMARY
+
+        return ConversationStage.QA
+
+    async def create_microbiome_analysis(
+            self,
+            conversation_history: List[Dict[str, str]],
+            relevant_chunks: List[str],
+            user_question: str = None,
+            on_text: Optional[Callable[[str], Awaitable[None]]] = None) -> Dict[str, Any]:
+        """
+        Create microbiome analysis using conversation history and relevant chunks
+        
+        Args:
+            conversation_history: Previous messages in thread, as OpenAI chat messages
+            relevant_chunks: Relevant PDF chunks from RAG
+            user_question: Current user question (if any)
+            on_text: If given, the response is streamed and each text delta is passed to it
+        
+        Returns:
+            Dict with response content, token usage, and cost
+        """
+
+        stage = self.determine_stage(conversation_history, user_question)
+        system_prompt = SYSTEM_PROMPTS[stage]
+
+        # Per-turn messages, placed after the cacheable prefix (base prompt + history)
+        turn_messages = [{"role": "system", "content": system_prompt}]
 
         # Add relevant chunks as context if available
         if relevant_chunks:
-            chunks_context = "\n\n".join(
-                [f"Report Section: {chunk}" for chunk in relevant_chunks])
-            context_message = f"Here are relevant sections from the user's microbiome report:\n\n{chunks_context}"
-            messages.append({"role": "system", "content": context_message})
-
-        # Add conversation history (map 'bot' role to 'assistant' for OpenAI)
-        for msg in conversation_history:
-            role = msg["role"]
-            if role == "bot":
-                role = "assistant"
-            messages.append({"role": role, "content": msg["content"]})
+            # One join with the section label folded into the separator: no per-chunk
+            # labelled copies or intermediate context string
+            context_message = REPORT_CONTEXT_PREFIX + REPORT_SECTION_SEPARATOR.join(
+                relevant_chunks)
+            turn_messages.append({"role": "system", "content": context_message})
 
         # Add current user question if provided
         if user_question:
-            messages.append({"role": "user", "content": user_question})
-
-        # Estimate total tokens and truncate if necessary
-        total_content = system_prompt + str(relevant_chunks) + str(
-            conversation_history) + (user_question or "")
-        estimated_tokens = self.count_tokens_rough(total_content)
-
-        # Truncate conversation history if too long
-        if estimated_tokens > MAX_CONTEXT_TOKENS * 0.8:  # Leave room for response
-            print(
-                f"⚠️  Truncating conversation history ({estimated_tokens} tokens)"
+            turn_messages.append({"role": "user", "content": user_question})
+
+        # Token budget for history: what's left of the prompt allowance (leaving room
+        # for the response) after the system prompts, report context and question
+        fixed_tokens = SYSTEM_PROMPT_TOKENS[stage] + sum(
+            self.count_tokens(msg["content"]) + TOKENS_PER_MESSAGE
+            for msg in turn_messages[1:])
+        history_budget = int(MAX_CONTEXT_TOKENS * 0.8) - fixed_tokens
+
+        # Add the most recent conversation history that fits the budget, newest first
+        # (entries are already in OpenAI chat form, so they are passed through as-is)
+        history_messages = []
+        for msg in reversed(conversation_history):
+            msg_tokens = self.count_tokens(msg["content"]) + TOKENS_PER_MESSAGE
+            if msg_tokens > history_budget:
+                break
+            history_budget -= msg_tokens
+            history_messages.append(msg)
+        if len(history_messages) < len(conversation_history):
+            logger.warning(
+                f"⚠️  Truncating conversation history (kept {len(history_messages)} of {len(conversation_history)} messages)"
             )
-            # Keep system messages and recent history
-            system_messages = [
-                msg for msg in messages if msg["role"] == "system"
-            ]
-            recent_messages = [
-                msg for msg in messages if msg["role"] != "system"
-            ][-10:]  # Last 10 messages
-            messages = system_messages + recent_messages
+
+        messages = [{"role": "system", "content": BASE_SYSTEM_PROMPT}]
+        messages.extend(reversed(history_messages))
+        messages.extend(turn_messages)
 
         try:
             # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
             # do not change this unless explicitly requested by the user
-            response = self.client.chat.completions.create(
-                model=CHAT_MODEL,
-                messages=messages,
-                max_tokens=600,  # Increased for structured conversation flow
-                temperature=0.7)
-
-            # Extract response data
-            content = response.choices[0].message.content
-            input_tokens = response.usage.prompt_tokens
-            output_tokens = response.usage.completion_tokens
-            cost = self.calculate_chat_cost(input_tokens, output_tokens)
+            if on_text is None:
+                response = await self.async_client.chat.completions.create(
+                    model=CHAT_MODEL,
+                    messages=messages,
+                    max_completion_tokens=CHAT_MAX_COMPLETION_TOKENS,
+                    temperature=0.7)
+
+                # Extract response data
+                content = response.choices[0].message.content
+                usage = response.usage
+            else:
+                stream = await self.async_client.chat.completions.create(
+                    model=CHAT_MODEL,
+                    messages=messages,
+                    max_completion_tokens=CHAT_MAX_COMPLETION_TOKENS,
+                    temperature=0.7,
+                    stream=True,
+                    # Token usage arrives in a final chunk with no choices
+                    stream_options={"include_usage": True})
+
+                parts = []
+                usage = None
+                async for chunk in stream:
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        delta = chunk.choices[0].delta.content
+                        parts.append(delta)
+                        await on_text(delta)
+                content = "".join(parts)
+
+            input_tokens = usage.prompt_tokens if usage else 0
+            output_tokens = usage.completion_tokens if usage else 0
+            details = usage.prompt_tokens_details if usage else None
+            cached_tokens = (details.cached_tokens or 0) if details else 0
+            self._prompt_tokens += input_tokens
+            self._cached_prompt_tokens += cached_tokens
+            logger.debug(f"Prompt cache: {cached_tokens}/{input_tokens} input tokens cached")
+            cost = self.calculate_chat_cost(input_tokens, output_tokens, cached_tokens)
 
             return {
                 "content": content,
@@ -248,10 +556,10 @@ Keep responses focused and under 800 characters. """
             }
 
         except Exception as e:
-            print(f"Error in OpenAI chat completion: {e}")
+            logger.error(f"Error in OpenAI chat completion: {e}")
             raise
 
-    def generate_executive_summary(
+    async def generate_executive_summary(
             self, pdf_content: str,
             user_metadata: Dict[str, Any]) -> Dict[str, Any]:
         """Generate executive summary for a new microbiome report"""
@@ -274,32 +582,21 @@ Keep responses focused and under 800 characters. """
             lifestyle_info
         ) if lifestyle_info else "No additional lifestyle information provided."
 
-        prompt = f"""Analyze this microbiome report and provide an executive summary with actionable insights.
-
-User Lifestyle Context:
-{lifestyle_context}
-
-Microbiome Report Content:
-{pdf_content[:4000]}  # Truncate for context limits
-
-Please provide:
-1. Key findings from the report
-2. Notable patterns or concerns
-3. Personalized recommendations based on their lifestyle
-4. One specific actionable next step they could consider
+        # Truncate for context limits
+        report_excerpt = _truncate_to_tokens(pdf_content, SUMMARY_REPORT_TOKENS)
 
-Keep the response engaging and supportive, focusing on practical insights."""
+        prompt = SUMMARY_PROMPT_TEMPLATE.substitute(
+            lifestyle_context=lifestyle_context, report_excerpt=report_excerpt)
 
         try:
-            response = self.client.chat.completions.create(model=CHAT_MODEL,
-                                                           messages=[{
-                                                               "role":
-                                                               "user",
-                                                               "content":
-                                                               prompt
-                                                           }],
-                                                           max_tokens=800,
-                                                           temperature=0.7)
+            response = await self.async_client.chat.completions.create(
+                model=CHAT_MODEL,
+                messages=[{
+                    "role": "user",
+                    "content": prompt
+                }],
+                max_completion_tokens=SUMMARY_MAX_COMPLETION_TOKENS,
+                temperature=0.7)
 
             content = response.choices[0].message.content
             input_tokens = response.usage.prompt_tokens
@@ -314,5 +611,5 @@ Keep the response engaging and supportive, focusing on practical insights."""
             }
 
         except Exception as e:
-            print(f"Error generating executive summary: {e}")
+            logger.error(f"Error generating executive summary: {e}")
             raise
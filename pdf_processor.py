@@ -1,32 +1,60 @@
 import PyPDF2
 import io
+import logging
+import mmap
 import re
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Optional, Union, BinaryIO
 from datetime import datetime
 from config import CHUNK_SIZE, CHUNK_OVERLAP
 
+logger = logging.getLogger(__name__)
+
+# PDFium (C++) text extraction when pypdfium2 is installed: several times faster than
+# PyPDF2 on long, table-heavy reports. PyPDF2 remains the fallback for both.
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+# Patterns compiled once at import rather than looked up in re's cache on every call
+CONTROL_CHARS_PATTERN = re.compile('[\x01-\x08\x0b\x0c\x0e-\x1f]+')  # Except tab, newline, CR
+PAGE_LABEL_PATTERN = re.compile(r'Page \d+')
+
+# Common date patterns in microbiome reports, most specific first. clean_text has joined
+# each page onto one line, so the gaps are bounded: a label with no date nearby fails
+# fast instead of scanning (and backtracking through) the rest of the page.
+DATE_REGEX = r'(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})'
+# Words between "sample"/"test" and its own "date" ("Sample Collection Date")
+LABEL_GAP = r'(?:(?!date).){0,40}?'
+# Between a label and its value: room for format hints, dot leaders and a table header
+# row, but never past the next "... date" label, whose value would be a different date
+VALUE_GAP = r'(?:(?!date).){0,160}?'
+DATE_PATTERNS = [
+    re.compile(r'sample' + LABEL_GAP + r'date' + VALUE_GAP + DATE_REGEX, re.IGNORECASE),
+    re.compile(r'collected' + VALUE_GAP + DATE_REGEX, re.IGNORECASE),
+    re.compile(r'test' + LABEL_GAP + r'date' + VALUE_GAP + DATE_REGEX, re.IGNORECASE),
+    re.compile(DATE_REGEX),  # Generic date
+]
+DATE_FORMATS = ['%m/%d/%Y', '%m-%d-%Y', '%m.%d.%Y', '%d/%m/%Y', '%m/%d/%y']
+
+LAB_PATTERNS = [
+    re.compile(r'(Viome|Thryve|uBiome|Gut Intelligence|Microba)', re.IGNORECASE),
+]
+
+# Diversity metrics
+DIVERSITY_PATTERNS = [
+    re.compile(r'shannon.*?diversity.*?(\d+\.?\d*)', re.IGNORECASE),
+    re.compile(r'simpson.*?index.*?(\d+\.?\d*)', re.IGNORECASE),
+]
+
 class PDFProcessor:
     def __init__(self):
         pass
     
-    def extract_text_from_pdf(self, pdf_bytes: bytes) -> str:
-        """Extract text content from PDF bytes"""
+    def extract_text_from_pdf(self, pdf_source: Union[bytes, BinaryIO, str]) -> str:
+        """Extract text content from PDF bytes, a seekable binary file object, or a file path"""
         try:
-            pdf_file = io.BytesIO(pdf_bytes)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            
-            text_content = []
-            for page in pdf_reader.pages:
-                try:
-                    text = page.extract_text()
-                    if text and text.strip():
-                        # Clean text immediately to prevent downstream issues
-                        cleaned_text = self.clean_text(text)
-                        if cleaned_text:
-                            text_content.append(cleaned_text)
-                except Exception as page_error:
-                    print(f"Warning: Failed to extract text from page: {page_error}")
-                    continue
+            text_content = self.extract_page_texts(pdf_source)
             
             if not text_content:
                 raise Exception("No readable text found in PDF")
@@ -35,21 +63,117 @@ class PDFProcessor:
             return full_text
             
         except Exception as e:
-            print(f"Error extracting PDF text: {e}")
+            logger.error(f"Error extracting PDF text: {e}")
             raise Exception(f"Failed to process PDF: {str(e)}")
     
+    def page_count(self, pdf_source: Union[bytes, BinaryIO, str]) -> int:
+        """Number of pages in the PDF, so extraction can be split into page ranges"""
+        try:
+            if pdfium is not None:
+                try:
+                    pdf = pdfium.PdfDocument(pdf_source)
+                except pdfium.PdfiumError:
+                    if hasattr(pdf_source, 'seek'):
+                        pdf_source.seek(0)
+                else:
+                    try:
+                        return len(pdf)
+                    finally:
+                        pdf.close()
+            
+            if isinstance(pdf_source, (bytes, bytearray)):
+                pdf_source = io.BytesIO(pdf_source)
+            return len(PyPDF2.PdfReader(pdf_source).pages)
+        
+        except Exception as e:
+            logger.error(f"Error reading PDF: {e}")
+            raise Exception(f"Failed to process PDF: {str(e)}")
+    
+    def extract_page_texts(self, pdf_source: Union[bytes, BinaryIO, str],
+                           first_page: int = 0, stop_page: Optional[int] = None) -> List[str]:
+        """Cleaned text of each readable page in [first_page, stop_page); pages without text are skipped"""
+        text_content = []
+        for text in self._page_texts(pdf_source, first_page, stop_page):
+            if text and text.strip():
+                # Clean text immediately to prevent downstream issues
+                cleaned_text = self.clean_text(text)
+                if cleaned_text:
+                    text_content.append(cleaned_text)
+        return text_content
+    
+    def _page_texts(self, pdf_source: Union[bytes, BinaryIO, str],
+                    first_page: int = 0, stop_page: Optional[int] = None) -> Iterator[str]:
+        """Raw text of each readable page in the range, via PDFium if available and PyPDF2 otherwise"""
+        pages = slice(first_page, stop_page)
+        if pdfium is not None:
+            try:
+                pdf = pdfium.PdfDocument(pdf_source)
+            except pdfium.PdfiumError as e:
+                # Malformed files PDFium rejects are sometimes still readable by PyPDF2
+                logger.warning(f"⚠️  PDFium could not open the PDF ({e}), falling back to PyPDF2")
+                if hasattr(pdf_source, 'seek'):
+                    pdf_source.seek(0)
+            else:
+                try:
+                    yield from self._pdfium_page_texts(pdf, pages)
+                finally:
+                    pdf.close()
+                return
+        
+        if isinstance(pdf_source, str):
+            # Memory-map files on disk: pages are read on demand instead of loading the whole PDF
+            with open(pdf_source, 'rb') as pdf_file, \
+                    mmap.mmap(pdf_file.fileno(), 0, access=mmap.ACCESS_READ) as pdf_map:
+                yield from self._pypdf2_page_texts(pdf_map, pages)
+        else:
+            # BytesIO shares the bytes buffer; file objects are read in place
+            pdf_file = io.BytesIO(pdf_source) if isinstance(pdf_source, (bytes, bytearray)) else pdf_source
+            yield from self._pypdf2_page_texts(pdf_file, pages)
+    
+    @staticmethod
+    def _pdfium_page_texts(pdf, pages: slice) -> Iterator[str]:
+        """Page texts from an open PDFium document, closing each page's native handles as it goes"""
+        for page_index in range(len(pdf))[pages]:
+            try:
+                page = pdf[page_index]
+                try:
+                    text_page = page.get_textpage()
+                    try:
+                        text = text_page.get_text_range()
+                    finally:
+                        text_page.close()
+                finally:
+                    page.close()
+            except Exception as page_error:
+                logger.warning(f"Warning: Failed to extract text from page: {page_error}")
+                continue
+            yield text
+    
+    @staticmethod
+    def _pypdf2_page_texts(pdf_file: BinaryIO, pages: slice) -> Iterator[str]:
+        """Page texts via PyPDF2 (pure Python)"""
+        pdf_reader = PyPDF2.PdfReader(pdf_file)
+        for page in pdf_reader.pages[pages]:
+            try:
+                text = page.extract_text()
+            except Exception as page_error:
+                logger.warning(f"Warning: Failed to extract text from page: {page_error}")
+                continue
+            yield text
+    
     def clean_text(self, text: str) -> str:
         """Clean and normalize extracted text"""
-        # Remove NUL characters and other problematic bytes
-        text = text.replace('\x00', ' ')  # Replace NUL characters
-        text = ''.join(char for char in text if ord(char) >= 32 or char in '\n\t\r')
+        # Remove NUL characters and other problematic bytes (one regex pass, not a
+        # Python-level loop over every character)
+        text = CONTROL_CHARS_PATTERN.sub('', text.replace('\x00', ' '))
         
-        # Remove excessive whitespace
-        text = re.sub(r'\s+', ' ', text)
+        # Remove excessive whitespace: split() breaks on the same characters as \s, and
+        # the leading/trailing space it drops would be stripped below anyway
+        text = ' '.join(text.split())
         
-        # Remove page numbers and common PDF artifacts
-        text = re.sub(r'\n\d+\n', '\n', text)
-        text = re.sub(r'Page \d+', '', text)
+        # Remove page labels and common PDF artifacts (standalone page-number lines
+        # can't survive the whitespace collapse above, so there is no pass for them)
+        text = PAGE_LABEL_PATTERN.sub('', text)
         
         # Fix common OCR issues
         text = text.replace('_', ' ')
@@ -58,45 +182,33 @@ class PDFProcessor:
     
     def extract_sample_date(self, text: str) -> Optional[datetime]:
         """Extract sample date from PDF text"""
-        # Common date patterns in microbiome reports
-        date_patterns = [
-            r'sample.*?date.*?(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',
-            r'collected.*?(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',
-            r'test.*?date.*?(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',
-            r'(\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})',  # Generic date
-        ]
-        
-        for pattern in date_patterns:
-            matches = re.findall(pattern, text.lower())
-            if matches:
-                date_str = matches[0]
-                try:
-                    # Try different date formats
-                    for fmt in ['%m/%d/%Y', '%m-%d-%Y', '%m.%d.%Y', '%d/%m/%Y', '%m/%d/%y']:
-                        try:
-                            return datetime.strptime(date_str, fmt)
-                        except ValueError:
-                            continue
-                except Exception:
-                    continue
+        for pattern in DATE_PATTERNS:
+            # Only the first match of each pattern is tried, so stop scanning there
+            match = pattern.search(text)
+            if match:
+                date_str = match.group(1)
+                # Try different date formats
+                for fmt in DATE_FORMATS:
+                    try:
+                        return datetime.strptime(date_str, fmt)
+                    except ValueError:
+                        continue
         
         return None
     
     def chunk_text(self, text: str) -> List[Dict[str, Any]]:
         """Split text into overlapping chunks for RAG"""
-        if not text:
-            return []
-        
         chunks = []
+        text_length = len(text)
         start = 0
         chunk_idx = 0
         
-        while start < len(text):
+        while start < text_length:
             # Calculate end position
             end = start + CHUNK_SIZE
             
             # If we're not at the end, try to break at a sentence or paragraph
-            if end < len(text):
+            if end < text_length:
                 # Look for sentence break
                 sentence_break = text.rfind('.', start, end)
                 if sentence_break > start + CHUNK_SIZE // 2:
@@ -118,12 +230,12 @@ class PDFProcessor:
                 })
                 chunk_idx += 1
             
-            # Move start position with overlap
-            start = max(start + CHUNK_SIZE - CHUNK_OVERLAP, end)
-            
-            # Prevent infinite loop
-            if start >= len(text):
+            if end >= text_length:
                 break
+            
+            # Start the next chunk CHUNK_OVERLAP characters before this one ended, so
+            # text near a boundary appears in both (and none falls between chunks)
+            start = max(end - CHUNK_OVERLAP, start + 1)
         
         return chunks
     
@@ -143,51 +255,47 @@ class PDFProcessor:
         
         # Extract other potential metadata
         # Look for lab name
-        lab_patterns = [
-            r'(Viome|Thryve|uBiome|Gut Intelligence|Microba)',
-        ]
-        for pattern in lab_patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
+        for pattern in LAB_PATTERNS:
+            matches = pattern.findall(text)
             if matches:
                 metadata['lab_name'] = matches[0]
                 break
         
         # Look for diversity metrics
-        diversity_patterns = [
-            r'shannon.*?diversity.*?(\d+\.?\d*)',
-            r'simpson.*?index.*?(\d+\.?\d*)',
-        ]
-        for pattern in diversity_patterns:
-            matches = re.findall(pattern, text.lower())
+        for pattern in DIVERSITY_PATTERNS:
+            matches = pattern.findall(text)
             if matches:
                 metadata['diversity_metrics'] = matches
                 break
         
         return metadata
     
-    def process_pdf(self, pdf_bytes: bytes) -> Dict[str, Any]:
+    def process_pdf(self, pdf_source: Union[bytes, BinaryIO, str]) -> Dict[str, Any]:
         """Complete PDF processing pipeline"""
         try:
             # Extract text
-            text_content = self.extract_text_from_pdf(pdf_bytes)
-            
-            if not text_content:
-                raise Exception("No text content found in PDF")
-            
-            # Extract metadata
-            metadata = self.extract_metadata(text_content)
-            
-            # Create chunks
-            chunks = self.chunk_text(text_content)
-            
-            return {
-                'text_content': text_content,
-                'metadata': metadata,
-                'chunks': chunks,
-                'total_chars': len(text_content),
-                'total_chunks': len(chunks)
-            }
+            text_content = self.extract_text_from_pdf(pdf_source)
+            return self.process_text(text_content)
             
         except Exception as e:
-            print(f"Error processing PDF: {e}")
+            logger.error(f"Error processing PDF: {e}")
             raise
+    
+    def process_text(self, text_content: str) -> Dict[str, Any]:
+        """Metadata and RAG chunks for a PDF's extracted text"""
+        if not text_content:
+            raise Exception("No text content found in PDF")
+        
+        # Extract metadata
+        metadata = self.extract_metadata(text_content)
+        
+        # Create chunks
+        chunks = self.chunk_text(text_content)
+        
+        return {
+            'text_content': text_content,
+            'metadata': metadata,
+            'chunks': chunks,
+            'total_chars': len(text_content),
+            'total_chunks': len(chunks)
+        }